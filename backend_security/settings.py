@@ -49,6 +49,7 @@ INSTALLED_APPS = [
     'django_ratelimit',
     'rest_framework',
     'rest_framework.authtoken',
+    'django_filters',
     'drf_yasg',
 ]
 
@@ -139,11 +140,103 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 RATELIMITS = {
     'default': '5/m',  # 5 requests per minute (for anonymous users)
     'authenticated': '10/m',  # 10 requests per minute (for authenticated users)
+    # Per endpoint group: a rate, or {'anonymous': ..., 'authenticated': ...}.
+    # Overrides the view's own rate; active RateLimitPolicy rows override these.
+    'groups': {},
 }
 
+# Scaling of resolved limits by reputation and load (ip_tracking.rate_policy)
+IP_TRACKING_RATE_POLICY = {
+    'cache_ttl': 60,            # Seconds reputation lookups are cached
+    'suspicious_factor': 0.2,   # IPs with an open SuspiciousIP incident
+    'trusted_factor': 5.0,      # Staff and members of trusted_groups
+    'trusted_groups': [],
+    'max_concurrency': 32,      # In-flight requests per process at full load
+    'target_latency': 0.5,      # Seconds; average latency at full load
+    'high_water': 0.8,          # Pressure above which limits shrink
+    'min_load_factor': 0.25,
+    'shed_pressure': 1.0,       # Pressure from which suspicious IPs get 503
+}
+
+# --- Detection rules evaluated by ip_tracking.tasks.flag_suspicious_ips ---
+# Each rule may match on path prefixes, path regexes, HTTP methods and
+# countries; an IP is flagged with `reason` when its hits within `window`
+# seconds exceed `threshold`. Countries match either the ISO code or the
+# country name. Unless IP_TRACKING_DETECTION_RULES is set, the defaults in
+# ip_tracking.rules.DEFAULT_DETECTION_RULES apply; more rules can be added
+# as DetectionRule rows.
+
+# Open suspicious-IP incidents not seen for this long (seconds) are resolved
+# by ip_tracking.tasks.expire_suspicious_ips
+IP_TRACKING_INCIDENT_IDLE_TIMEOUT = 86400
+
+# --- Request log sink ---
+# 'db' writes RequestLog rows directly (spooling only when the database
+# errors, if a spool directory is set); 'spool' always appends to the
+# local spool, replayed by `manage.py replay_spool` or replay_request_spool.
+IP_TRACKING_LOG_SINK = os.getenv('IP_TRACKING_LOG_SINK', 'db')
+
+IP_TRACKING_SPOOL = {
+    'directory': os.getenv('IP_TRACKING_SPOOL_DIR'),
+    'segment_bytes': 64 * 1024 * 1024,
+    'segment_age': 60,        # Seal open segments after this many seconds
+    'fsync_every': 256,       # Records per fsync
+    'fsync_interval': 1.0,    # Max seconds between fsyncs
+}
+
+# --- Traffic sketches ---
+# Fixed-memory heavy-hitter and distinct-IP tracking fed by IPLoggingMiddleware.
+# Each worker writes its sketches to Redis per time bucket; readers merge them.
+IP_TRACKING_SKETCHES = {
+    'enabled': os.getenv('IP_TRACKING_SKETCHES_ENABLED', 'True') == 'True',
+    'redis_url': None,          # Defaults to the default cache's LOCATION
+    'bucket_seconds': 300,
+    'retention': 2 * 3600,      # Seconds buckets are kept in Redis
+    'flush_interval': 5,        # Seconds between flushes per worker
+    'socket_timeout': 0.5,      # Seconds; Redis connect and command timeout
+    'cms_width': 4096,
+    'cms_depth': 4,
+    'top_k': 200,
+}
+
+# --- Startup ---
+# Seconds between blocklist snapshot version checks in each worker
+IP_TRACKING_BLOCKLIST_REFRESH = 10
+# Seconds after which a snapshot is reloaded even if the version is unchanged
+IP_TRACKING_BLOCKLIST_MAX_AGE = 300
+
+# Print how long each lazily-initialized ip_tracking component takes to load
+IP_TRACKING_STARTUP_TIMINGS = os.getenv('IP_TRACKING_STARTUP_TIMINGS') == 'True'
+
 # --- Geolocation API Key config ---
 IPGEOLOCATION_API_KEY = os.getenv('IPGEOLOCATION_API_KEY')
 
+# Upstream geolocation client: pooled, bounded, with a circuit breaker
+IP_TRACKING_GEO_PROVIDER = {
+    'base_url': 'https://api.ipgeolocation.io',
+    'connect_timeout': 0.5,
+    'read_timeout': 1.5,
+    'pool_size': 10,
+    'max_concurrency': 8,      # Concurrent upstream calls per process
+    'failure_threshold': 5,    # Consecutive failures that open the circuit
+    'reset_timeout': 30,       # Seconds before a trial call is let through
+}
+
+# --- Local geolocation index and geo-blocking policy ---
+# CSV of IP ranges (start_ip,end_ip,country_code,country,asn,isp), or the
+# .bin file compiled from it by `manage.py build_geo_index` (memory-mapped)
+IP_TRACKING_GEO_INDEX_PATH = os.getenv('IP_TRACKING_GEO_INDEX_PATH')
+
+# Evaluated by IPLoggingMiddleware against the local index only
+IP_TRACKING_GEO_POLICY = {
+    'default': 'allow',     # Decision for IPs not covered by the index
+    'allow_countries': [],  # When set, only these countries are allowed
+    'deny_countries': [],   # Country codes or names
+    'allow_asns': [],       # Always allowed, overriding country rules
+    'deny_asns': [],
+    'deny_isps': [],
+}
+
 # Redis Cache Setting
 CACHES = {
     'default': {
@@ -14,30 +14,62 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from functools import lru_cache
+
 from django.contrib import admin
 from django.urls import path, include, re_path
 from rest_framework import permissions
-from drf_yasg.views import get_schema_view
-from drf_yasg import openapi
-
-schema_view = get_schema_view(
-   openapi.Info(
-      title="My API",
-      default_version='v1',
-      description="Test description",
-      terms_of_service="https://www.example.com/terms/",
-      contact=openapi.Contact(email="contact@example.com"),
-      license=openapi.License(name="BSD License"),
-   ),
-   public=True,
-   permission_classes=(permissions.AllowAny,),
-)
+
+from ip_tracking.startup import timed
+
+
+@lru_cache(maxsize=None)
+def get_schema_view():
+    """Import drf_yasg and build the schema view on the first docs request, not at boot"""
+    with timed('schema view build'):
+        from drf_yasg import openapi
+        from drf_yasg.views import get_schema_view as build_schema_view
+
+        return build_schema_view(
+           openapi.Info(
+              title="My API",
+              default_version='v1',
+              description="Test description",
+              terms_of_service="https://www.example.com/terms/",
+              contact=openapi.Contact(email="contact@example.com"),
+              license=openapi.License(name="BSD License"),
+           ),
+           public=True,
+           permission_classes=(permissions.AllowAny,),
+        )
+
+
+@lru_cache(maxsize=None)
+def get_schema_ui_view(renderer):
+    schema_view = get_schema_view()
+    if renderer is None:
+        return schema_view.without_ui(cache_timeout=0)
+    return schema_view.with_ui(renderer, cache_timeout=0)
+
+
+def schema_json(request, *args, **kwargs):
+    return get_schema_ui_view(None)(request, *args, **kwargs)
+
+
+def schema_swagger_ui(request, *args, **kwargs):
+    return get_schema_ui_view('swagger')(request, *args, **kwargs)
+
+
+def schema_redoc(request, *args, **kwargs):
+    return get_schema_ui_view('redoc')(request, *args, **kwargs)
+
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('api/', include('ip_tracking.urls')),
     
     # Swagger UI
-    re_path(r'^swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=0), name='schema-json'),
-    path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
-    path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
+    re_path(r'^swagger(?P<format>\.json|\.yaml)$', schema_json, name='schema-json'),
+    path('swagger/', schema_swagger_ui, name='schema-swagger-ui'),
+    path('redoc/', schema_redoc, name='schema-redoc'),
 ]
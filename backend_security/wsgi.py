@@ -14,3 +14,11 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend_security.settings')
 
 application = get_wsgi_application()
+
+# With a pre-forking server that loads the app in its master process
+# (gunicorn --preload), load ip_tracking's data once here so every worker
+# shares it copy-on-write.
+if os.getenv('IP_TRACKING_PREFORK_WARMUP') == 'True':
+    from ip_tracking.startup import warm_up
+
+    warm_up()
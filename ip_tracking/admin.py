@@ -1,3 +1,187 @@
-from django.contrib import admin
+import ipaddress
+import json
 
-# Register your models here.
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
+from django.db import connections
+
+from .blocklist import invalidate_blocklist
+from .models import BlockedIP, DetectionRule, RateLimitPolicy, RequestLog, SuspiciousIP
+
+CURSOR_VAR = 'after'
+COUNT_CAP = 10000
+
+
+def estimate_count(queryset):
+    """
+    Return (count, label) without an exact COUNT(*) over a large table.
+
+    PostgreSQL uses the planner's row estimate; other backends count at most
+    COUNT_CAP rows.
+    """
+    queryset = queryset.order_by().values('pk')
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        count = int(plan[0]['Plan']['Plan Rows'])
+        return count, f"~{count}"
+
+    count = queryset[:COUNT_CAP + 1].count()
+    if count > COUNT_CAP:
+        return COUNT_CAP, f"{COUNT_CAP}+"
+    return count, str(count)
+
+
+class KeysetChangeList(ChangeList):
+    """Change list paginated by primary key (?after=<pk>) instead of LIMIT/OFFSET"""
+
+    def __init__(self, request, *args, **kwargs):
+        try:
+            self.cursor = int(request.GET[CURSOR_VAR])
+        except (KeyError, ValueError):
+            self.cursor = None
+        super().__init__(request, *args, **kwargs)
+        # Filter and date-hierarchy links start again from the first page
+        self.params.pop(CURSOR_VAR, None)
+        self.filter_params.pop(CURSOR_VAR, None)
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_ordering(self, request, queryset):
+        # Keyset pagination needs a stable order on an indexed column
+        return ['-pk']
+
+    def get_results(self, request):
+        queryset = self.queryset
+        if self.cursor is not None:
+            queryset = queryset.filter(pk__lt=self.cursor)
+        rows = list(queryset[:self.list_per_page + 1])
+
+        self.result_list = rows[:self.list_per_page]
+        self.next_cursor = self.result_list[-1].pk if len(rows) > self.list_per_page else None
+        self.result_count, self.result_count_label = estimate_count(self.queryset)
+        self.full_result_count = None
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.can_show_all = False
+        self.multi_page = self.cursor is not None or self.next_cursor is not None
+        self.paginator = None
+
+    def first_page_url(self):
+        return self.get_query_string()
+
+    def next_page_url(self):
+        return self.get_query_string({CURSOR_VAR: self.next_cursor})
+
+
+class KeysetModelAdmin(admin.ModelAdmin):
+    """Admin for large tables: keyset pagination, estimated counts, no column sorting"""
+    change_list_template = 'admin/ip_tracking/keyset_change_list.html'
+    show_full_result_count = False
+    sortable_by = ()
+    ordering = ('-pk',)
+    search_help_text = 'Exact IP address, or a path prefix.'
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_actions(self, request):
+        # delete_selected loads every selected row; use the bulk actions instead
+        actions = super().get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    def get_search_results(self, request, queryset, search_term):
+        """Only search indexed columns: exact IP, else a path prefix where available"""
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        try:
+            ipaddress.ip_address(search_term)
+        except ValueError:
+            if any(field.name == 'path' for field in self.model._meta.fields):
+                return queryset.filter(path__startswith=search_term), False
+            return queryset.none(), False
+        return queryset.filter(ip_address=search_term), False
+
+
+def block_ips(modeladmin, request, queryset, reason):
+    # Counted and inserted in the database: "select all" may cover millions of rows
+    selected = queryset.order_by().values('ip_address').distinct().count()
+    created = BlockedIP.objects.block_from(queryset, reason)
+    invalidate_blocklist()
+    modeladmin.message_user(
+        request,
+        f"Blocked {created} IP addresses ({selected - created} were already blocked).",
+        messages.SUCCESS,
+    )
+
+
+@admin.register(RequestLog)
+class RequestLogAdmin(KeysetModelAdmin):
+    list_display = ('ip_address', 'method', 'path', 'country', 'city', 'timestamp')
+    date_hierarchy = 'timestamp'
+    search_fields = ('ip_address', 'path')
+    actions = ['block_selected_ips']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('geolocation_data')
+
+    def has_add_permission(self, request):
+        # Logs are written by IPLoggingMiddleware only
+        return False
+
+    @admin.action(description='Block IP addresses of selected requests')
+    def block_selected_ips(self, request, queryset):
+        block_ips(self, request, queryset, 'Blocked from request log admin')
+
+
+@admin.register(BlockedIP)
+class BlockedIPAdmin(KeysetModelAdmin):
+    list_display = ('ip_address', 'reason', 'created_at')
+    search_fields = ('ip_address',)
+    actions = ['unblock_selected']
+
+    @admin.action(description='Unblock selected IP addresses')
+    def unblock_selected(self, request, queryset):
+        deleted, _ = queryset.delete()
+        self.message_user(request, f"Unblocked {deleted} IP addresses.", messages.SUCCESS)
+
+
+@admin.register(SuspiciousIP)
+class SuspiciousIPAdmin(KeysetModelAdmin):
+    list_display = ('ip_address', 'reason', 'request_count', 'detected_at', 'last_seen', 'is_resolved')
+    list_filter = ('is_resolved',)
+    search_fields = ('ip_address',)
+    actions = ['resolve_selected', 'block_selected_ips']
+
+    @admin.action(description='Resolve selected incidents')
+    def resolve_selected(self, request, queryset):
+        resolved = queryset.resolve()
+        self.message_user(request, f"Resolved {resolved} incidents.", messages.SUCCESS)
+
+    @admin.action(description='Block IP addresses of selected incidents')
+    def block_selected_ips(self, request, queryset):
+        block_ips(self, request, queryset, 'Blocked from suspicious IP admin')
+
+
+@admin.register(DetectionRule)
+class DetectionRuleAdmin(admin.ModelAdmin):
+    list_display = ('name', 'reason', 'threshold', 'window_seconds', 'is_active')
+    list_filter = ('is_active', 'reason')
+    search_fields = ('name',)
+
+
+@admin.register(RateLimitPolicy)
+class RateLimitPolicyAdmin(admin.ModelAdmin):
+    list_display = ('group', 'rate', 'authenticated_rate', 'is_active', 'updated_at')
+    list_filter = ('is_active',)
+    search_fields = ('group',)
@@ -0,0 +1,293 @@
+"""
+Offline, columnar copies of RequestLog for forensics.
+
+``export_partitions`` streams RequestLog rows into one directory per UTC day::
+
+    <root>/2026-10-19/
+        meta.json           row count, column dtypes and string dictionaries
+        timestamp.i8        int64 epoch seconds
+        ip.i4 path.i4 ...   int32 codes into the column's dictionary
+                            (country holds the name, country_code the ISO code)
+
+Columns are raw little-endian arrays, so ``load_partition`` memory-maps them
+with NumPy and the aggregations below run vectorized over the mapped data
+without touching the primary database.
+"""
+import json
+import os
+import shutil
+from datetime import datetime, time as dt_time, timedelta, timezone as dt_timezone
+from pathlib import Path
+
+import numpy as np
+
+TIMESTAMP_DTYPE = np.dtype('<i8')
+CODE_DTYPE = np.dtype('<i4')
+CODED_COLUMNS = ('ip', 'path', 'method', 'country', 'country_code')
+SOURCE_FIELDS = ('timestamp', 'ip_address', 'path', 'method', 'country', 'geolocation_data__country_code')
+BUCKET_SECONDS = {'hour': 3600, 'day': 86400}
+
+
+def partition_name(day):
+    return day.isoformat()
+
+
+def _day_bounds(day):
+    start = datetime.combine(day, dt_time.min, tzinfo=dt_timezone.utc)
+    return start, start + timedelta(days=1)
+
+
+def export_partition(root, day, chunk_size=50000):
+    """Export one UTC day of RequestLog; returns the number of rows written"""
+    from .models import RequestLog
+
+    start, end = _day_bounds(day)
+    rows = (RequestLog.objects
+            .filter(timestamp__gte=start, timestamp__lt=end)
+            .order_by()
+            .values_list(*SOURCE_FIELDS))
+
+    final_dir = Path(root) / partition_name(day)
+    work_dir = Path(root) / f".{partition_name(day)}.tmp"
+    shutil.rmtree(work_dir, ignore_errors=True)
+    work_dir.mkdir(parents=True)
+
+    dictionaries = {column: {} for column in CODED_COLUMNS}
+    files = {'timestamp': open(work_dir / 'timestamp.i8', 'wb')}
+    for column in CODED_COLUMNS:
+        files[column] = open(work_dir / f'{column}.i4', 'wb')
+
+    def encode(column, values):
+        codes = dictionaries[column]
+        return np.fromiter(
+            (codes.setdefault(value or '', len(codes)) for value in values),
+            dtype=CODE_DTYPE, count=len(values),
+        )
+
+    total = 0
+    try:
+        chunk = []
+        for row in rows.iterator(chunk_size=chunk_size):
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                total += _write_chunk(files, chunk, encode)
+                chunk = []
+        if chunk:
+            total += _write_chunk(files, chunk, encode)
+    finally:
+        for f in files.values():
+            f.close()
+
+    meta = {
+        'rows': total,
+        'day': partition_name(day),
+        'columns': {
+            'timestamp': {'file': 'timestamp.i8', 'dtype': TIMESTAMP_DTYPE.str},
+            **{
+                column: {
+                    'file': f'{column}.i4',
+                    'dtype': CODE_DTYPE.str,
+                    'dictionary': list(dictionaries[column]),
+                }
+                for column in CODED_COLUMNS
+            },
+        },
+    }
+    with open(work_dir / 'meta.json', 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+    # Swap in the new export. The previous one is renamed aside first and
+    # deleted only once the new one is in place; until then readers fall
+    # back to it (see load_partitions), and a crash never loses the day.
+    previous_dir = _previous_dir(root, day)
+    if final_dir.exists():
+        shutil.rmtree(previous_dir, ignore_errors=True)
+        os.replace(final_dir, previous_dir)
+    os.replace(work_dir, final_dir)
+    shutil.rmtree(previous_dir, ignore_errors=True)
+    return total
+
+
+def _previous_dir(root, day):
+    return Path(root) / f".{partition_name(day)}.old"
+
+
+def _write_chunk(files, chunk, encode):
+    timestamps, ips, paths, methods, countries, country_codes = zip(*chunk)
+    np.fromiter(
+        (int(ts.timestamp()) for ts in timestamps), dtype=TIMESTAMP_DTYPE, count=len(chunk)
+    ).tofile(files['timestamp'])
+    encode('ip', ips).tofile(files['ip'])
+    encode('path', paths).tofile(files['path'])
+    encode('method', methods).tofile(files['method'])
+    encode('country', countries).tofile(files['country'])
+    encode('country_code', country_codes).tofile(files['country_code'])
+    return len(chunk)
+
+
+class Partition:
+    """One exported day: memory-mapped columns plus their dictionaries"""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        with open(self.directory / 'meta.json', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.rows = self.meta['rows']
+
+    def column(self, name):
+        spec = self.meta['columns'][name]
+        if not self.rows:
+            return np.empty(0, dtype=np.dtype(spec['dtype']))
+        return np.memmap(self.directory / spec['file'], dtype=np.dtype(spec['dtype']), mode='r')
+
+    def dictionary(self, name):
+        return self.meta['columns'][name]['dictionary']
+
+    def has_column(self, name):
+        return name in self.meta['columns']
+
+
+def load_partitions(root, since=None, until=None):
+    """Return exported partitions whose day falls within [since, until]"""
+    directories = {}
+    for directory in Path(root).iterdir():
+        name = directory.name
+        if name.startswith('.') and name.endswith('.old'):
+            # Previous export of a day whose replacement is being swapped in
+            name = name[1:-len('.old')]
+        elif name.startswith('.'):
+            continue
+        if (directory / 'meta.json').exists() and not (
+            name in directories and directories[name].name == name
+        ):
+            directories[name] = directory
+
+    partitions = []
+    for name in sorted(directories):
+        day = datetime.strptime(name, '%Y-%m-%d').date()
+        if (since and day < since.date()) or (until and day > until.date()):
+            continue
+        partitions.append(Partition(directories[name]))
+    return partitions
+
+
+class GlobalDictionary:
+    """Merges per-partition dictionaries so codes are comparable across days"""
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def remap(self, local_values):
+        """Array mapping local codes to global codes"""
+        remap = np.empty(len(local_values), dtype=CODE_DTYPE)
+        for local_code, value in enumerate(local_values):
+            code = self.codes.get(value)
+            if code is None:
+                code = self.codes[value] = len(self.values)
+                self.values.append(value)
+            remap[local_code] = code
+        return remap
+
+
+def _mask(partition, since, until, path_prefix, country, method):
+    timestamps = partition.column('timestamp')
+    mask = np.ones(partition.rows, dtype=bool)
+    if since is not None:
+        mask &= timestamps >= int(since.timestamp())
+    if until is not None:
+        mask &= timestamps < int(until.timestamp())
+    # String predicates are evaluated once per dictionary entry, then
+    # applied to the rows by indexing with the codes
+    if path_prefix:
+        matches = np.array([p.startswith(path_prefix) for p in partition.dictionary('path')], dtype=bool)
+        mask &= matches[partition.column('path')]
+    if country:
+        # Like detection rules, accept the country name or its ISO code
+        # (exports made before the country_code column only have names)
+        matches = np.array([c.upper() == country.upper() for c in partition.dictionary('country')], dtype=bool)
+        country_mask = matches[partition.column('country')]
+        if partition.has_column('country_code'):
+            matches = np.array(
+                [c.upper() == country.upper() for c in partition.dictionary('country_code')], dtype=bool
+            )
+            country_mask |= matches[partition.column('country_code')]
+        mask &= country_mask
+    if method:
+        matches = np.array([m.upper() == method.upper() for m in partition.dictionary('method')], dtype=bool)
+        mask &= matches[partition.column('method')]
+    return mask
+
+
+def top_k(partitions, key, k=10, by=None, since=None, until=None,
+          path_prefix=None, country=None, method=None):
+    """
+    Count rows per ``key`` (or per (key, by) pair) and return the k largest
+    as [(key_value, by_value_or_None, count), ...].
+    """
+    key_dictionary = GlobalDictionary()
+    by_dictionary = GlobalDictionary()
+    pair_counts = []
+
+    for partition in partitions:
+        if not partition.rows:
+            continue
+        mask = _mask(partition, since, until, path_prefix, country, method)
+        keys = key_dictionary.remap(partition.dictionary(key))[partition.column(key)[mask]]
+        if by is None:
+            pair_counts.append(np.bincount(keys).astype(np.int64))
+        else:
+            by_codes = by_dictionary.remap(partition.dictionary(by))[partition.column(by)[mask]]
+            pairs = keys.astype(np.int64) << 32 | by_codes.astype(np.int64)
+            pair_counts.append(np.unique(pairs, return_counts=True))
+
+    if by is None:
+        counts = np.zeros(len(key_dictionary.values), dtype=np.int64)
+        for partial in pair_counts:
+            counts[:len(partial)] += partial
+        top = _largest(counts, k)
+        return [(key_dictionary.values[code], None, int(counts[code])) for code in top]
+
+    if not pair_counts:
+        return []
+    pairs = np.concatenate([pairs for pairs, _ in pair_counts])
+    counts = np.concatenate([counts for _, counts in pair_counts])
+    pairs, inverse = np.unique(pairs, return_inverse=True)
+    counts = np.bincount(inverse, weights=counts).astype(np.int64)
+    top = _largest(counts, k)
+    return [
+        (key_dictionary.values[pairs[i] >> 32], by_dictionary.values[pairs[i] & 0xFFFFFFFF], int(counts[i]))
+        for i in top
+    ]
+
+
+def _largest(counts, k):
+    """Indices of the k largest counts, largest first, skipping zeros"""
+    if len(counts) > k:
+        candidates = np.argpartition(counts, -k)[-k:]
+    else:
+        candidates = np.arange(len(counts))
+    ordered = candidates[np.argsort(counts[candidates], kind='stable')[::-1]]
+    return [i for i in ordered if counts[i] > 0]
+
+
+def histogram(partitions, bucket='hour', since=None, until=None,
+              path_prefix=None, country=None, method=None):
+    """Return [(bucket_start_datetime, count), ...] for matching rows"""
+    width = BUCKET_SECONDS[bucket]
+    totals = {}
+    for partition in partitions:
+        if not partition.rows:
+            continue
+        mask = _mask(partition, since, until, path_prefix, country, method)
+        buckets = partition.column('timestamp')[mask] // width
+        if not len(buckets):
+            continue
+        first = int(buckets.min())
+        for offset, count in enumerate(np.bincount(buckets - first)):
+            if count:
+                totals[first + offset] = totals.get(first + offset, 0) + int(count)
+    return [
+        (datetime.fromtimestamp(b * width, tz=dt_timezone.utc), totals[b])
+        for b in sorted(totals)
+    ]
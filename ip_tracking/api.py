@@ -0,0 +1,166 @@
+from django.db import transaction
+from django_filters.rest_framework import DjangoFilterBackend
+from rest_framework import mixins, permissions, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from .blocklist import invalidate_blocklist
+from .models import BlockedIP, SuspiciousIP
+from .serializers import (
+    MAX_BULK_ITEMS,
+    BlockedIPSerializer,
+    BulkBlockedIPSerializer,
+    BulkResolveSerializer,
+    IPAddressListSerializer,
+    SuspiciousIPSerializer,
+)
+from .sketches import get_sketch_settings, load_sketches
+
+BULK_BATCH_SIZE = 1000
+
+
+def chunked(items, size=BULK_BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class IdCursorPagination(CursorPagination):
+    """Cursor pagination over the primary key index (no COUNT, no OFFSET)"""
+    ordering = '-id'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class BlockedIPViewSet(mixins.ListModelMixin,
+                       mixins.RetrieveModelMixin,
+                       mixins.CreateModelMixin,
+                       mixins.DestroyModelMixin,
+                       viewsets.GenericViewSet):
+    """
+    Manage the IP blocklist.
+
+    POST accepts a single object or a list of up to 10,000 objects; lists
+    are inserted with bulk_create in one transaction and already-blocked
+    IPs are skipped.
+    """
+    queryset = BlockedIP.objects.all()
+    serializer_class = BlockedIPSerializer
+    permission_classes = [permissions.IsAdminUser]
+    pagination_class = IdCursorPagination
+    filter_backends = [DjangoFilterBackend]
+    filterset_fields = ['ip_address']  # Unique index
+
+    def create(self, request, *args, **kwargs):
+        if not isinstance(request.data, list):
+            return super().create(request, *args, **kwargs)
+
+        serializer = BulkBlockedIPSerializer(
+            data=request.data, many=True, max_length=MAX_BULK_ITEMS, context=self.get_serializer_context()
+        )
+        serializer.is_valid(raise_exception=True)
+
+        # Last entry wins for IPs repeated within the payload
+        rows = {item['ip_address']: item for item in serializer.validated_data}
+        ip_addresses = list(rows)
+
+        with transaction.atomic():
+            existing = set()
+            for batch in chunked(ip_addresses):
+                existing.update(
+                    BlockedIP.objects.filter(ip_address__in=batch).values_list('ip_address', flat=True)
+                )
+            new_rows = [BlockedIP(**rows[ip]) for ip in ip_addresses if ip not in existing]
+            # ignore_conflicts covers IPs blocked concurrently by another writer
+            BlockedIP.objects.bulk_create(new_rows, batch_size=BULK_BATCH_SIZE, ignore_conflicts=True)
+            # bulk_create returns every submitted object, inserted or not
+            created = BlockedIP.objects.count_blocked(ip_addresses, BULK_BATCH_SIZE) - len(existing)
+        invalidate_blocklist()
+
+        return Response(
+            {'created': created, 'skipped': len(request.data) - created},
+            status=status.HTTP_201_CREATED,
+        )
+
+    @action(detail=False, methods=['post'], url_path='bulk-delete')
+    def bulk_delete(self, request):
+        """Unblock up to 10,000 IPs in one transaction"""
+        serializer = IPAddressListSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ip_addresses = list(dict.fromkeys(serializer.validated_data['ip_addresses']))
+
+        deleted = 0
+        with transaction.atomic():
+            for batch in chunked(ip_addresses):
+                count, _ = BlockedIP.objects.filter(ip_address__in=batch).delete()
+                deleted += count
+
+        return Response({'deleted': deleted})
+
+
+class SuspiciousIPViewSet(viewsets.ReadOnlyModelViewSet):
+    """List suspicious IPs and resolve them in bulk"""
+    queryset = SuspiciousIP.objects.all()
+    serializer_class = SuspiciousIPSerializer
+    permission_classes = [permissions.IsAdminUser]
+    pagination_class = IdCursorPagination
+    filter_backends = [DjangoFilterBackend]
+    filterset_fields = ['ip_address', 'is_resolved']  # Indexed columns
+
+    @action(detail=False, methods=['post'], url_path='bulk-resolve')
+    def bulk_resolve(self, request):
+        """Resolve open incidents by id and/or IP with a single UPDATE"""
+        serializer = BulkResolveSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        open_incidents = SuspiciousIP.objects.open()
+        ids = serializer.validated_data.get('ids')
+        ip_addresses = serializer.validated_data.get('ip_addresses')
+        if ids:
+            open_incidents = open_incidents.filter(id__in=ids)
+        if ip_addresses:
+            open_incidents = open_incidents.filter(ip_address__in=ip_addresses)
+
+        return Response({'resolved': open_incidents.resolve()})
+
+
+class TrafficStatsView(APIView):
+    """
+    Heavy hitters and distinct-IP counts over the last ``minutes`` (default 60),
+    merged from every worker's traffic sketches. Counts are estimates.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        options = get_sketch_settings()
+        try:
+            minutes = int(request.query_params.get('minutes', 60))
+            top = int(request.query_params.get('top', 20))
+        except ValueError:
+            return Response({'error': 'minutes and top must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+        minutes = max(1, min(minutes, options['retention'] // 60))
+        top = max(1, min(top, options['top_k']))
+
+        try:
+            sketches = load_sketches(minutes * 60, options)
+        except Exception as e:
+            return Response({'error': f'Traffic sketches unavailable: {e}'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        heavy_hitters = [
+            {
+                'ip_address': ip,
+                # Both estimates over-count; the smaller one is the tighter bound
+                'requests': min(count, sketches.requests.estimate(ip)),
+                'guaranteed': count - error,
+            }
+            for ip, count, error in sketches.heavy_hitters.top(top)
+        ]
+        return Response({
+            'minutes': minutes,
+            'distinct_ips': sketches.distinct_ips.count(),
+            'heavy_hitters': heavy_hitters,
+            'distinct_ips_by_path': {key: hll.count() for key, hll in sketches.groups['path'].items()},
+            'distinct_ips_by_country': {key: hll.count() for key, hll in sketches.groups['country'].items()},
+        })
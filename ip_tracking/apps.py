@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class IpTrackingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ip_tracking'
+
+    def ready(self):
+        from .startup import timed
+
+        with timed('import ip_tracking.signals'):
+            from . import signals  # noqa: F401
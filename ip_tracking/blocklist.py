@@ -0,0 +1,125 @@
+"""
+In-memory snapshot of the IP blocklist.
+
+``IPLoggingMiddleware`` checks IPs against a frozenset loaded from
+``BlockedIP`` instead of querying the database on every request. The
+snapshot is loaded in a background thread on first use and refreshed when
+the blocklist version (bumped by ``invalidate_blocklist()``) changes, at
+most every ``IP_TRACKING_BLOCKLIST_REFRESH`` seconds. As a safety net for
+changes that bypass the version, it is also reloaded once older than
+``IP_TRACKING_BLOCKLIST_MAX_AGE`` seconds. Until the first load completes,
+checks fall back to the per-request database query.
+"""
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+from .startup import timed
+
+BLOCKLIST_VERSION_CACHE_KEY = 'ip_tracking:blocklist_version'
+
+
+class BlocklistSnapshot:
+    def __init__(self, refresh_interval=10, max_age=300):
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.ips = None
+        self.version = None
+        self._loaded_at = None
+        self._checked_at = None
+        self._loading = False
+        self._lock = threading.Lock()
+
+    def is_blocked(self, ip_address):
+        ips = self.ips
+        self._maybe_refresh()
+        if ips is None:
+            from .models import BlockedIP
+
+            # Snapshot not loaded yet: answer from the database
+            return BlockedIP.objects.filter(ip_address=ip_address).exists()
+        return ip_address in ips
+
+    def load(self):
+        """Load the snapshot synchronously"""
+        from .models import BlockedIP
+
+        with timed('blocklist snapshot load'):
+            version = cache.get(BLOCKLIST_VERSION_CACHE_KEY, 0)
+            ips = frozenset(
+                BlockedIP.objects.values_list('ip_address', flat=True).iterator(chunk_size=10000)
+            )
+        self.ips = ips
+        self.version = version
+        self._loaded_at = self._checked_at = time.monotonic()
+
+    def _maybe_refresh(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.refresh_interval:
+            return
+        with self._lock:
+            if self._loading:
+                return
+            self._loading = True
+            self._checked_at = now
+        self._start_refresh()
+
+    def _start_refresh(self):
+        threading.Thread(target=self._refresh_in_thread, name='blocklist-snapshot', daemon=True).start()
+
+    def _refresh_in_thread(self):
+        try:
+            self._refresh()
+        finally:
+            # This thread's database connection is not reused by requests
+            connection.close()
+
+    def _refresh(self):
+        try:
+            if (self.ips is None
+                    or time.monotonic() - self._loaded_at >= self.max_age
+                    or cache.get(BLOCKLIST_VERSION_CACHE_KEY, 0) != self.version):
+                self.load()
+        except Exception as e:
+            # Keep serving the previous snapshot (or the database fallback)
+            print(f"Error loading blocklist snapshot: {e}")
+        finally:
+            self._loading = False
+
+    def _after_fork(self):
+        # A refresh thread running at fork time does not exist in the child
+        self._loading = False
+        self._lock = threading.Lock()
+
+
+_snapshot_lock = threading.Lock()
+_snapshot = None
+
+
+def get_blocklist():
+    """Return the per-process blocklist snapshot (not loaded until first use)"""
+    global _snapshot
+    if _snapshot is None:
+        with _snapshot_lock:
+            if _snapshot is None:
+                _snapshot = BlocklistSnapshot(
+                    getattr(settings, 'IP_TRACKING_BLOCKLIST_REFRESH', 10),
+                    getattr(settings, 'IP_TRACKING_BLOCKLIST_MAX_AGE', 300),
+                )
+                os.register_at_fork(after_in_child=_snapshot._after_fork)
+    return _snapshot
+
+
+def invalidate_blocklist():
+    """Make every process reload its snapshot on its next refresh"""
+    try:
+        cache.incr(BLOCKLIST_VERSION_CACHE_KEY)
+    except ValueError:
+        cache.set(BLOCKLIST_VERSION_CACHE_KEY, 1, None)
+    if _snapshot is not None:
+        # Reload this process right away
+        _snapshot._checked_at = None
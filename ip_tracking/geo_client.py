@@ -0,0 +1,188 @@
+"""
+HTTP client for the upstream geolocation provider (ipgeolocation.io).
+
+One ``GeoProviderClient`` is shared per process. It keeps a persistent
+connection pool with strict connect/read timeouts, bounds the number of
+concurrent upstream calls, coalesces concurrent lookups of the same IP into
+one request, supports the bulk endpoint, and trips a circuit breaker so a
+degraded provider fails fast instead of tying up request threads.
+"""
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+# Rate limited or quota exhausted, bad or revoked API key: retrying won't help
+PROVIDER_FAILURE_STATUSES = {401, 403, 429}
+
+DEFAULT_GEO_PROVIDER = {
+    'base_url': 'https://api.ipgeolocation.io',
+    'connect_timeout': 0.5,
+    'read_timeout': 1.5,
+    'pool_size': 10,
+    'max_concurrency': 8,      # Concurrent upstream calls per process
+    'acquire_timeout': 0.05,   # Wait for a free slot before giving up
+    'failure_threshold': 5,    # Consecutive failures that open the circuit
+    'reset_timeout': 30,       # Seconds before a trial call is let through
+    'batch_size': 50,          # Max IPs per bulk request
+}
+
+
+class GeoProviderError(Exception):
+    """The provider could not answer the lookup"""
+
+
+class CircuitOpenError(GeoProviderError):
+    """The provider is considered degraded; the call was not attempted"""
+
+
+class ProviderBusyError(GeoProviderError):
+    """All upstream slots are busy; the call was not attempted"""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with a single half-open trial call"""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return True if a call may go upstream now"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self.clock() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+
+class GeoProviderClient:
+    """Pooled, bounded and coalescing client for ipgeolocation.io"""
+
+    def __init__(self, api_key, base_url=DEFAULT_GEO_PROVIDER['base_url'],
+                 connect_timeout=0.5, read_timeout=1.5, pool_size=10,
+                 max_concurrency=8, acquire_timeout=0.05, failure_threshold=5,
+                 reset_timeout=30, batch_size=50):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.acquire_timeout = acquire_timeout
+        self.batch_size = batch_size
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+    def lookup(self, ip_address):
+        """Look up one IP; concurrent callers for the same IP share one request"""
+        with self._inflight_lock:
+            future = self._inflight.get(ip_address)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[ip_address] = future
+
+        if leader:
+            try:
+                future.set_result(self._request('GET', '/ipgeo', params={'ip': ip_address}))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._inflight_lock:
+                    del self._inflight[ip_address]
+
+        return future.result(timeout=sum(self.timeout))
+
+    def lookup_many(self, ip_addresses):
+        """Look up many IPs through the bulk endpoint; returns {ip: data}"""
+        unique_ips = list(dict.fromkeys(ip_addresses))
+        results = {}
+        for start in range(0, len(unique_ips), self.batch_size):
+            batch = unique_ips[start:start + self.batch_size]
+            for geo_data in self._request('POST', '/ipgeo-bulk', json={'ips': batch}):
+                if 'ip' in geo_data:
+                    results[geo_data['ip']] = geo_data
+        return results
+
+    def _request(self, method, path, params=None, json=None):
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise ProviderBusyError("Too many concurrent geolocation lookups")
+        try:
+            if not self.breaker.allow():
+                raise CircuitOpenError("Geolocation provider circuit is open")
+            response = self.session.request(
+                method,
+                f"{self.base_url}{path}",
+                params={'apiKey': self.api_key, **(params or {})},
+                json=json,
+                timeout=self.timeout,
+            )
+        except requests.RequestException as e:
+            self.breaker.record_failure()
+            raise GeoProviderError(str(e)) from e
+        finally:
+            self._slots.release()
+
+        if response.status_code >= 500 or response.status_code in PROVIDER_FAILURE_STATUSES:
+            self.breaker.record_failure()
+            raise GeoProviderError(f"Provider returned HTTP {response.status_code}")
+        # Any other 4xx (e.g. bogon IP) is an answer, not a sign of a degraded provider
+        self.breaker.record_success()
+        if response.status_code >= 400:
+            raise GeoProviderError(f"Provider returned HTTP {response.status_code}")
+        return response.json()
+
+
+_client_lock = threading.Lock()
+_client = None
+
+
+def get_provider_client():
+    """Return the shared per-process provider client"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                options = {**DEFAULT_GEO_PROVIDER, **getattr(settings, 'IP_TRACKING_GEO_PROVIDER', {})}
+                _client = GeoProviderClient(settings.IPGEOLOCATION_API_KEY, **options)
+    return _client
+
+
+def reset_provider_client():
+    """Close the shared client so the next call rebuilds it from settings"""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.session.close()
+        _client = None
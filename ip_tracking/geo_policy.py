@@ -0,0 +1,127 @@
+"""
+Country and ISP/ASN allow/deny policies.
+
+The policy in ``settings.IP_TRACKING_GEO_POLICY`` is compiled against the
+local ``GeoIndex`` into a merged range -> decision table, so evaluating it
+for a request is a cached bisect over that table: no geolocation lookup and
+never an external API call.
+"""
+import ipaddress
+import threading
+from bisect import bisect_right
+from functools import lru_cache
+
+from django.conf import settings
+
+from .geolocation import get_geo_index
+from .startup import timed
+
+ALLOW = 'allow'
+DENY = 'deny'
+
+DEFAULT_GEO_POLICY = {
+    'default': ALLOW,       # Decision for IPs not covered by the index
+    'allow_countries': [],  # When set, only these countries are allowed
+    'deny_countries': [],
+    'allow_asns': [],       # Always allowed, overriding country rules
+    'deny_asns': [],
+    'deny_isps': [],
+    'cache_size': 65536,    # Per-process decision cache (IPs)
+}
+
+
+def normalize_asn(asn):
+    asn = str(asn or '').strip().upper()
+    return asn[2:] if asn.startswith('AS') else asn
+
+
+class GeoPolicy:
+    """A geo policy compiled into per-IP-version range -> decision tables"""
+
+    def __init__(self, policy, index):
+        policy = {**DEFAULT_GEO_POLICY, **policy}
+        self.default_deny = policy['default'] == DENY
+        self.allow_countries = {c.upper() for c in policy['allow_countries']}
+        self.deny_countries = {c.upper() for c in policy['deny_countries']}
+        self.allow_asns = {normalize_asn(a) for a in policy['allow_asns']}
+        self.deny_asns = {normalize_asn(a) for a in policy['deny_asns']}
+        self.deny_isps = {i.upper() for i in policy['deny_isps']}
+        self.is_active = bool(
+            self.default_deny or self.allow_countries or self.deny_countries
+            or self.deny_asns or self.deny_isps
+        )
+
+        self.starts = {}
+        self.ends = {}
+        self.decisions = {}
+        for version in (4, 6):
+            self._compile(version, index.ranges(version) if self.is_active else ())
+
+        self.is_denied = lru_cache(maxsize=policy['cache_size'])(self._is_denied)
+
+    def decide(self, record):
+        """Return True when a range with these attributes must be denied"""
+        asn = normalize_asn(record.asn)
+        if asn and asn in self.allow_asns:
+            return False
+        countries = {value.upper() for value in (record.country_code, record.country) if value}
+        if self.allow_countries and not countries & self.allow_countries:
+            return True
+        if countries & self.deny_countries:
+            return True
+        if asn and asn in self.deny_asns:
+            return True
+        if record.isp and record.isp.upper() in self.deny_isps:
+            return True
+        return False
+
+    def _compile(self, version, ranges):
+        starts, ends, decisions = [], [], []
+        for start, end, record in ranges:
+            denied = self.decide(record)
+            # Merge adjacent ranges that share a decision
+            if decisions and decisions[-1] == denied and ends[-1] + 1 >= start:
+                ends[-1] = max(ends[-1], end)
+                continue
+            starts.append(start)
+            ends.append(end)
+            decisions.append(denied)
+        self.starts[version] = starts
+        self.ends[version] = ends
+        self.decisions[version] = decisions
+
+    def _is_denied(self, ip_address):
+        if not self.is_active:
+            return False
+        try:
+            ip = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return self.default_deny
+        value = int(ip)
+        position = bisect_right(self.starts[ip.version], value) - 1
+        if position < 0 or value > self.ends[ip.version][position]:
+            return self.default_deny
+        return self.decisions[ip.version][position]
+
+
+_policy_lock = threading.Lock()
+_policy = None
+
+
+def get_geo_policy():
+    """Return the compiled geo policy, compiling it on first use"""
+    global _policy
+    if _policy is None:
+        with _policy_lock:
+            if _policy is None:
+                index = get_geo_index()
+                with timed('geo policy compile'):
+                    _policy = GeoPolicy(getattr(settings, 'IP_TRACKING_GEO_POLICY', {}), index)
+    return _policy
+
+
+def reset_geo_policy():
+    """Drop the compiled policy (and its decision cache) after a policy change"""
+    global _policy
+    with _policy_lock:
+        _policy = None
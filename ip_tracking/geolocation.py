@@ -0,0 +1,323 @@
+"""
+IP geolocation.
+
+``GeoIndex`` is a local, sorted IP range table (country, ASN and ISP per
+range) loaded from ``settings.IP_TRACKING_GEO_INDEX_PATH``. The source is a
+CSV file with the columns::
+
+    start_ip,end_ip,country_code,country,asn,isp
+
+``manage.py build_geo_index`` compiles it into a fixed-width binary file
+(``*.bin``), which ``MappedGeoIndex`` memory-maps on first use: lookups
+bisect the mapped pages directly, nothing is parsed at boot, and worker
+processes share the pages through the OS page cache.
+
+``GeolocationService`` answers lookups from the cache and the local index,
+and only goes to the upstream ipgeolocation.io API for the extra details
+(city, region, coordinates) when ``IPGEOLOCATION_API_KEY`` is configured,
+through the shared client in ``geo_client``.
+"""
+import csv
+import ipaddress
+import json
+import mmap
+import struct
+import threading
+from bisect import bisect_right
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .geo_client import get_provider_client
+from .startup import timed
+
+GEOLOCATION_CACHE_TIMEOUT = 86400  # 24 hours
+
+INDEX_MAGIC = b'IPGEOIX1'
+INDEX_HEADER = struct.Struct('>QQQ')  # v4 ranges, v6 ranges, records JSON bytes
+RECORD_ID = struct.Struct('>I')
+KEY_WIDTHS = {4: 4, 6: 16}  # Big-endian keys sort like the addresses
+
+
+class GeoRecord:
+    """Geolocation attributes shared by one IP range"""
+    __slots__ = ('country_code', 'country', 'asn', 'isp')
+
+    def __init__(self, country_code, country, asn, isp):
+        self.country_code = country_code or None
+        self.country = country or None
+        self.asn = asn or None
+        self.isp = isp or None
+
+    def as_dict(self):
+        return {
+            'country_code': self.country_code,
+            'country': self.country,
+            'asn': self.asn,
+            'isp': self.isp,
+        }
+
+
+class GeoIndex:
+    """Sorted IP range table with O(log n) lookups, one table per IP version"""
+
+    def __init__(self, rows=()):
+        tables = {4: [], 6: []}
+        for start, end, record in rows:
+            tables[start.version].append((int(start), int(end), record))
+
+        self.starts = {}
+        self.ends = {}
+        self.records = {}
+        for version, table in tables.items():
+            table.sort(key=lambda row: row[0])
+            self.starts[version] = [row[0] for row in table]
+            self.ends[version] = [row[1] for row in table]
+            self.records[version] = [row[2] for row in table]
+
+    @classmethod
+    def from_csv(cls, path):
+        def rows():
+            with open(path, newline='', encoding='utf-8') as f:
+                for row in csv.reader(f):
+                    if not row or row[0].startswith('#') or row[0] == 'start_ip':
+                        continue
+                    start, end, country_code, country, asn, isp = (row + [''] * 6)[:6]
+                    yield (ipaddress.ip_address(start), ipaddress.ip_address(end),
+                           GeoRecord(country_code, country, asn, isp))
+        return cls(rows())
+
+    def __len__(self):
+        return sum(len(starts) for starts in self.starts.values())
+
+    def ranges(self, version):
+        """Iterate (start, end, record) for one IP version in address order"""
+        return zip(self.starts[version], self.ends[version], self.records[version])
+
+    def lookup(self, ip_address):
+        """Return the ``GeoRecord`` covering ``ip_address``, or None"""
+        try:
+            ip = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return None
+        value = int(ip)
+        position = bisect_right(self.starts[ip.version], value) - 1
+        if position < 0 or value > self.ends[ip.version][position]:
+            return None
+        return self.records[ip.version][position]
+
+    def save(self, path):
+        """Write the index in the binary format read by ``MappedGeoIndex``"""
+        record_ids = {}
+        records = []
+        tables = {}
+        for version, width in KEY_WIDTHS.items():
+            entries = bytearray()
+            for start, end, record in self.ranges(version):
+                key = (record.country_code, record.country, record.asn, record.isp)
+                if key not in record_ids:
+                    record_ids[key] = len(records)
+                    records.append(key)
+                entries += start.to_bytes(width, 'big')
+                entries += end.to_bytes(width, 'big')
+                entries += RECORD_ID.pack(record_ids[key])
+            tables[version] = entries
+
+        records_json = json.dumps(records).encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(INDEX_MAGIC)
+            f.write(INDEX_HEADER.pack(len(self.starts[4]), len(self.starts[6]), len(records_json)))
+            f.write(tables[4])
+            f.write(tables[6])
+            f.write(records_json)
+
+
+class _MappedKeys:
+    """Read-only sequence of fixed-width big-endian keys inside an mmap"""
+
+    def __init__(self, buffer, offset, count, stride, width):
+        self.buffer = buffer
+        self.offset = offset
+        self.count = count
+        self.stride = stride
+        self.width = width
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        start = self.offset + position * self.stride
+        return self.buffer[start:start + self.width]
+
+
+class MappedGeoIndex:
+    """``GeoIndex`` backed by a memory-mapped binary file"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError(f"{path} is not a compiled geolocation index")
+
+        counts = {}
+        counts[4], counts[6], records_length = INDEX_HEADER.unpack_from(self.buffer, len(INDEX_MAGIC))
+        offset = len(INDEX_MAGIC) + INDEX_HEADER.size
+        self.keys = {}
+        for version, width in KEY_WIDTHS.items():
+            stride = 2 * width + RECORD_ID.size
+            self.keys[version] = _MappedKeys(self.buffer, offset, counts[version], stride, width)
+            offset += counts[version] * stride
+        self.records_offset = offset
+        self.records_length = records_length
+        self._records = None
+
+    @property
+    def records(self):
+        # Decoded on the first lookup, not when the file is mapped
+        if self._records is None:
+            start = self.records_offset
+            raw = json.loads(self.buffer[start:start + self.records_length])
+            self._records = [GeoRecord(*values) for values in raw]
+        return self._records
+
+    def __len__(self):
+        return sum(len(keys) for keys in self.keys.values())
+
+    def _entry(self, version, position):
+        keys = self.keys[version]
+        start = keys.offset + position * keys.stride
+        end = self.buffer[start + keys.width:start + 2 * keys.width]
+        (record_id,) = RECORD_ID.unpack_from(self.buffer, start + 2 * keys.width)
+        return end, self.records[record_id]
+
+    def ranges(self, version):
+        """Iterate (start, end, record) for one IP version in address order"""
+        keys = self.keys[version]
+        for position in range(len(keys)):
+            end, record = self._entry(version, position)
+            yield int.from_bytes(keys[position], 'big'), int.from_bytes(end, 'big'), record
+
+    def lookup(self, ip_address):
+        """Return the ``GeoRecord`` covering ``ip_address``, or None"""
+        try:
+            ip = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return None
+        key = ip.packed
+        position = bisect_right(self.keys[ip.version], key) - 1
+        if position < 0:
+            return None
+        end, record = self._entry(ip.version, position)
+        return record if key <= end else None
+
+
+def load_geo_index(path):
+    """Map a compiled ``.bin`` index, or parse a CSV source"""
+    if not path:
+        return GeoIndex()
+    if str(path).endswith('.bin'):
+        return MappedGeoIndex(path)
+    return GeoIndex.from_csv(path)
+
+
+_index_lock = threading.Lock()
+_index = None
+
+
+def get_geo_index():
+    """Load the local geolocation index on first use"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                with timed('geo index load'):
+                    _index = load_geo_index(getattr(settings, 'IP_TRACKING_GEO_INDEX_PATH', None))
+    return _index
+
+
+def reset_geo_index():
+    """Drop the loaded index so it is reloaded on next use"""
+    global _index
+    with _index_lock:
+        _index = None
+
+
+class GeolocationService:
+    """Geolocation lookups backed by the cache, the local index and the upstream API"""
+
+    def get_geolocation(self, ip_address):
+        """Get geolocation data for IP with 24-hour caching"""
+        cache_key = f"ip_geolocation_{ip_address}"
+
+        # Try to get from cache first
+        cached_data = cache.get(cache_key)
+        if cached_data:
+            return cached_data
+
+        record = get_geo_index().lookup(ip_address)
+        data = record.as_dict() if record else {}
+
+        if settings.IPGEOLOCATION_API_KEY:
+            upstream = self.fetch_upstream(ip_address)
+            if 'error' in upstream:
+                # Don't cache failures; retry on the next request
+                return dict(data, error=upstream['error'])
+            data.update({key: value for key, value in upstream.items() if value is not None})
+
+        cache.set(cache_key, data, GEOLOCATION_CACHE_TIMEOUT)
+        return data
+
+    def get_geolocation_many(self, ip_addresses):
+        """Get geolocation data for many IPs using one bulk upstream call for the misses"""
+        cache_keys = {ip: f"ip_geolocation_{ip}" for ip in ip_addresses}
+        cached = cache.get_many(list(cache_keys.values()))
+        results = {ip: cached[key] for ip, key in cache_keys.items() if cached.get(key)}
+
+        misses = [ip for ip in cache_keys if ip not in results]
+        if not misses:
+            return results
+
+        index = get_geo_index()
+        for ip in misses:
+            record = index.lookup(ip)
+            results[ip] = record.as_dict() if record else {}
+
+        if settings.IPGEOLOCATION_API_KEY:
+            try:
+                upstream = get_provider_client().lookup_many(misses)
+            except Exception as e:
+                print(f"Bulk geolocation error for {len(misses)} IPs: {e}")
+                return results
+            for ip, geo_data in upstream.items():
+                if ip in results:
+                    parsed = parse_ipgeolocation(geo_data)
+                    results[ip].update({key: value for key, value in parsed.items() if value is not None})
+
+        cache.set_many({cache_keys[ip]: results[ip] for ip in misses}, GEOLOCATION_CACHE_TIMEOUT)
+        return results
+
+    def fetch_upstream(self, ip_address):
+        """Query the provider for a single IP through the shared pooled client"""
+        try:
+            return parse_ipgeolocation(get_provider_client().lookup(ip_address))
+        except Exception as e:
+            # Return empty data if geolocation fails
+            print(f"Geolocation error for IP {ip_address}: {e}")
+            return {'error': str(e)}
+
+
+def parse_ipgeolocation(geo_data):
+    """Extract the fields we store from an ipgeolocation.io response"""
+    time_zone = geo_data.get('time_zone') or {}
+    return {
+        'country': geo_data.get('country_name'),
+        'country_code': geo_data.get('country_code2'),
+        'city': geo_data.get('city'),
+        'region': geo_data.get('state_prov'),
+        'latitude': geo_data.get('latitude'),
+        'longitude': geo_data.get('longitude'),
+        'timezone': time_zone.get('name'),
+        'isp': geo_data.get('isp'),
+        'asn': geo_data.get('asn'),
+        'raw_data': geo_data  # Store complete response
+    }
@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Aggregate exported RequestLog partitions (top-k, group-by, time histograms)'
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'source',
+            type=str,
+            help='Directory written by export_request_logs'
+        )
+        
+        parser.add_argument(
+            '--days',
+            type=int,
+            help='Only rows from the last N days'
+        )
+        
+        parser.add_argument('--path-prefix', type=str, help='Only paths starting with this prefix')
+        parser.add_argument('--country', type=str, help='Only requests from this country (name or ISO code)')
+        parser.add_argument('--method', type=str, help='Only this HTTP method')
+        
+        parser.add_argument(
+            '--top',
+            choices=['ip', 'path', 'country', 'country_code', 'method'],
+            default='ip',
+            help='Column to rank (default: ip)'
+        )
+        
+        parser.add_argument(
+            '--by',
+            choices=['ip', 'path', 'country', 'country_code', 'method'],
+            help='Also group by this column'
+        )
+        
+        parser.add_argument('-k', type=int, default=20, help='Number of rows to show')
+        
+        parser.add_argument(
+            '--histogram',
+            choices=['hour', 'day'],
+            help='Show request counts per time bucket instead of a ranking'
+        )
+    
+    def handle(self, *args, **options):
+        try:
+            from ip_tracking import analytics
+        except ImportError as e:
+            raise CommandError(f'Log analytics requires NumPy: {e}')
+        
+        since = None
+        if options['days']:
+            since = datetime.now(dt_timezone.utc) - timedelta(days=options['days'])
+        
+        try:
+            partitions = analytics.load_partitions(options['source'], since=since)
+        except OSError as e:
+            raise CommandError(f'Could not read {options["source"]}: {e}')
+        
+        filters = {
+            'since': since,
+            'path_prefix': options['path_prefix'],
+            'country': options['country'],
+            'method': options['method'],
+        }
+        
+        if options['histogram']:
+            for bucket_start, count in analytics.histogram(partitions, options['histogram'], **filters):
+                self.stdout.write(f'{bucket_start:%Y-%m-%d %H:%M}  {count}')
+            return
+        
+        results = analytics.top_k(partitions, options['top'], k=options['k'], by=options['by'], **filters)
+        for key, by_value, count in results:
+            label = f'{key or "-"}  {by_value or "-"}' if options['by'] else (key or '-')
+            self.stdout.write(f'{count:>10}  {label}')
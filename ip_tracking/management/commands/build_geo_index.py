@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from ip_tracking.geolocation import GeoIndex
+
+
+class Command(BaseCommand):
+    help = 'Compile a CSV geolocation range file into the memory-mapped .bin index'
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'source',
+            type=str,
+            help='CSV file: start_ip,end_ip,country_code,country,asn,isp'
+        )
+        
+        parser.add_argument(
+            'output',
+            type=str,
+            help='Output path (must end in .bin)'
+        )
+    
+    def handle(self, *args, **options):
+        if not options['output'].endswith('.bin'):
+            raise CommandError('Output path must end in .bin')
+        
+        try:
+            index = GeoIndex.from_csv(options['source'])
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Could not read {options["source"]}: {e}')
+        
+        index.save(options['output'])
+        
+        self.stdout.write(
+            self.style.SUCCESS(f'Wrote {len(index)} ranges to {options["output"]}.')
+        )
@@ -0,0 +1,58 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+
+class Command(BaseCommand):
+    help = 'Export RequestLog into daily columnar partitions for offline analysis'
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'output',
+            type=str,
+            help='Directory holding one partition per UTC day'
+        )
+        
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=1,
+            help='Number of days to export, ending with --until (default: 1)'
+        )
+        
+        parser.add_argument(
+            '--until',
+            type=str,
+            help='Last day to export, YYYY-MM-DD (default: today, UTC)'
+        )
+        
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=50000,
+            help='Rows fetched and written per chunk'
+        )
+    
+    def handle(self, *args, **options):
+        try:
+            from ip_tracking.analytics import export_partition
+        except ImportError as e:
+            raise CommandError(f'Log analytics requires NumPy: {e}')
+        
+        until = timezone.now().date()
+        if options['until']:
+            until = parse_date(options['until'])
+            if until is None:
+                raise CommandError('--until must be a date in YYYY-MM-DD format')
+        
+        total = 0
+        for offset in range(options['days'] - 1, -1, -1):
+            day = until - timedelta(days=offset)
+            rows = export_partition(options['output'], day, chunk_size=options['chunk_size'])
+            self.stdout.write(f'{day}: {rows} rows')
+            total += rows
+        
+        self.stdout.write(
+            self.style.SUCCESS(f'Export complete. {total} rows written to {options["output"]}.')
+        )
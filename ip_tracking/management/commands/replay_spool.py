@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from ip_tracking.spool import get_spool_settings, replay_spool
+
+
+class Command(BaseCommand):
+    help = 'Replay sealed request-log spool segments into the database'
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--directory',
+            type=str,
+            help='Spool directory (defaults to IP_TRACKING_SPOOL["directory"])'
+        )
+        
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Records inserted per transaction'
+        )
+    
+    def handle(self, *args, **options):
+        directory = options['directory'] or get_spool_settings()['directory']
+        if not directory:
+            self.stdout.write(self.style.WARNING('No spool directory configured.'))
+            return
+        
+        inserted = replay_spool(directory, batch_size=options['batch_size'])
+        
+        self.stdout.write(
+            self.style.SUCCESS(f'Replay complete. {inserted} request logs loaded from {directory}.')
+        )
@@ -1,19 +1,51 @@
-from django.http import HttpResponseForbidden
-from .models import RequestLog, BlockedIP
+import time
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils import timezone
+from django.utils.functional import cached_property
+from .models import RequestLog
+from .blocklist import get_blocklist
 from .geolocation import GeolocationService
+from .geo_policy import get_geo_policy
+from .rate_policy import get_rate_policy
+from .sketches import get_sketch_recorder
+from .spool import get_spool_writer
 
 class IPLoggingMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
-        self.geolocation_service = GeolocationService()
+
+    @cached_property
+    def geolocation_service(self):
+        # Built on the first logged request rather than at worker boot
+        return GeolocationService()
     
     def __call__(self, request):
         # Check if IP is blocked BEFORE processing the request
         if self.is_ip_blocked(request):
             return HttpResponseForbidden("IP address blocked")
+
+        # Apply country/ASN policy from the local geolocation index
+        if self.is_geo_blocked(request):
+            return HttpResponseForbidden("Access from your location is not allowed")
+
+        # Under overload, turn away clients with an open incident first
+        if self.is_shed(request):
+            response = HttpResponse("Server is busy, please retry later", status=503)
+            response['Retry-After'] = '30'
+            return response
         
-        # Process the request and get the response
-        response = self.get_response(request)
+        # Process the request and get the response, feeding the load signals
+        # used by the rate policy
+        load = get_rate_policy().load
+        load.started()
+        started_at = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            load.finished(time.perf_counter() - started_at)
         
         # Log the request details after getting the response
         self.log_request(request)
@@ -24,56 +56,30 @@ class IPLoggingMiddleware:
         """Check if the client IP is in the blocked list"""
         try:
             ip_address = self.get_client_ip(request)
-            return BlockedIP.objects.filter(ip_address=ip_address).exists()
+            return get_blocklist().is_blocked(ip_address)
         except Exception as e:
             # If there's an error checking, allow the request (fail open)
             print(f"Error checking IP block: {e}")
             return False
-    
-
-    def get_geolocation_data(self, ip_address):
-        """Get geolocation data for IP with 24-hour caching"""
-        cache_key = f"ip_geolocation_{ip_address}"
 
-        # Try to get from cache first
-        cached_data = cache.get(cache_key)
-        if cached_data:
-            return cached_data
+    def is_geo_blocked(self, request):
+        """Check the client IP against the compiled geo policy (cached per IP)"""
+        try:
+            return get_geo_policy().is_denied(self.get_client_ip(request))
+        except Exception as e:
+            # Fail open, like the blocklist check
+            print(f"Error checking geo policy: {e}")
+            return False
 
+    def is_shed(self, request):
+        """Check whether the rate policy sheds this client under the current load"""
         try:
-            # Get geolocation using django-ipgeolocation
-            geolocator = Geolocation()
-            geo_data = geolocator.get_geolocation(ip=ip_address)
-            
-            # Extract relevant fields
-            processed_data = {
-                'country': geo_data.get('country'),
-                'country_code': geo_data.get('country_code'),
-                'city': geo_data.get('city'),
-                'region': geo_data.get('region'),
-                'latitude': geo_data.get('latitude'),
-                'longitude': geo_data.get('longitude'),
-                'timezone': geo_data.get('timezone'),
-                'isp': geo_data.get('isp'),
-                'raw_data': geo_data  # Store complete response
-            }
-            
-            # Cache for 24 hours (86400 seconds)
-            cache.set(cache_key, processed_data, 86400)
-            
-            return processed_data
-    
+            return get_rate_policy().should_shed(self.get_client_ip(request))
         except Exception as e:
-            # Return empty data if geolocation fails
-            print(f"Geolocation error for IP {ip_address}: {e}")
-            return {
-                'country': None,
-                'city': None,
-                'region': None,
-                'latitude': None,
-                'longitude': None,
-                'error': str(e)
-            }
+            # Fail open, like the blocklist check
+            print(f"Error checking load shedding: {e}")
+            return False
+    
 
     def log_request(self, request):
         """Extract and log IP address, timestamp, path, and geolocation"""
@@ -84,17 +90,48 @@ class IPLoggingMiddleware:
             # Get geolocation data using our enhanced service
             geolocation_data = self.geolocation_service.get_geolocation(ip_address)
             
+            record = {
+                'ip_address': ip_address,
+                'timestamp': timezone.now(),
+                'path': request.path,
+                'method': request.method,
+                'country': geolocation_data.get('country'),
+                'city': geolocation_data.get('city'),
+                'region': geolocation_data.get('region'),
+                'latitude': geolocation_data.get('latitude'),
+                'longitude': geolocation_data.get('longitude'),
+                'geolocation_data': geolocation_data,
+            }
+            # Paths are client-chosen; never let one fail the insert
+            RequestLog.clip_fields(record)
+
+            # Feed the heavy-hitter and distinct-IP sketches
+            recorder = get_sketch_recorder()
+            if recorder is not None:
+                recorder.record(ip_address, request.path, record['country'])
+        except Exception as e:
+            # Log the error but don't break the application
+            print(f"Error logging request: {e}")
+            return
+
+        spool = get_spool_writer()
+        try:
+            if spool is not None and getattr(settings, 'IP_TRACKING_LOG_SINK', 'db') == 'spool':
+                spool.append(record)
+                return
             # Create and save the log entry
-            RequestLog.objects.create(
-                ip_address=ip_address,
-                path=request.path,
-                country=geolocation_data.get('country'),
-                city=geolocation_data.get('city'),
-                region=geolocation_data.get('region'),
-                latitude=geolocation_data.get('latitude'),
-                longitude=geolocation_data.get('longitude'),
-                geolocation_data=geolocation_data
-            )
+            RequestLog.objects.create(**record)
+        except (OperationalError, InterfaceError) as e:
+            # Only connectivity problems are spooled: a row the database
+            # rejects would fail again on every replay
+            if spool is None:
+                print(f"Error logging request: {e}")
+                return
+            # Keep the record on local disk until the database is back
+            try:
+                spool.append(record)
+            except Exception as e:
+                print(f"Error spooling request: {e}")
         except Exception as e:
             # Log the error but don't break the application
             print(f"Error logging request: {e}")
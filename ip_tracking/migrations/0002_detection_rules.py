@@ -0,0 +1,39 @@
+# Generated by Django 5.2.8 on 2026-10-19 20:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ip_tracking', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DetectionRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('reason', models.CharField(choices=[('high_volume', 'High request volume'), ('sensitive_access', 'Access to sensitive paths'), ('multiple_sensitive', 'Multiple sensitive path accesses'), ('suspicious_pattern', 'Suspicious behavior pattern')], max_length=50)),
+                ('path_prefixes', models.JSONField(blank=True, default=list)),
+                ('path_regexes', models.JSONField(blank=True, default=list)),
+                ('methods', models.JSONField(blank=True, default=list)),
+                ('countries', models.JSONField(blank=True, default=list)),
+                ('threshold', models.PositiveIntegerField(default=0)),
+                ('window_seconds', models.PositiveIntegerField(default=3600)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Detection rule',
+                'verbose_name_plural': 'Detection rules',
+                'db_table': 'detection_rules',
+            },
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='method',
+            field=models.CharField(blank=True, max_length=10, null=True),
+        ),
+    ]
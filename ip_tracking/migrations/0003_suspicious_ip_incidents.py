@@ -0,0 +1,49 @@
+# Generated by Django 5.2.8 on 2026-10-19 20:10
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import Count, F, Sum
+
+
+def collapse_open_incidents(apps, schema_editor):
+    """Seed last_seen and merge duplicate open incidents before the constraint"""
+    SuspiciousIP = apps.get_model('ip_tracking', 'SuspiciousIP')
+    SuspiciousIP.objects.update(last_seen=F('detected_at'))
+
+    duplicates = (SuspiciousIP.objects
+                  .filter(is_resolved=False)
+                  .values('ip_address', 'reason')
+                  .annotate(rows=Count('id'), total=Sum('request_count'))
+                  .filter(rows__gt=1))
+    now = django.utils.timezone.now()
+    for duplicate in list(duplicates):
+        incidents = SuspiciousIP.objects.filter(
+            ip_address=duplicate['ip_address'], reason=duplicate['reason'], is_resolved=False
+        )
+        keeper = incidents.order_by('-detected_at', '-id').first()
+        incidents.exclude(pk=keeper.pk).update(is_resolved=True, resolved_at=now)
+        SuspiciousIP.objects.filter(pk=keeper.pk).update(request_count=duplicate['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ip_tracking', '0002_detection_rules'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='suspiciousip',
+            name='last_seen',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(collapse_open_incidents, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='suspiciousip',
+            index=models.Index(fields=['is_resolved', 'last_seen'], name='suspicious__is_reso_55210c_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='suspiciousip',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_resolved', False)), fields=('ip_address', 'reason'), name='unique_open_incident'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.8 on 2026-10-19 20:22
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ip_tracking', '0004_request_log_spool'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateLimitPolicy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group', models.CharField(max_length=100, unique=True)),
+                ('rate', models.CharField(max_length=20, validators=[django.core.validators.RegexValidator('^(\\d+)/(\\d*)([smhd])$', 'Enter a rate such as "10/m" or "100/5m".')])),
+                ('authenticated_rate', models.CharField(blank=True, max_length=20, validators=[django.core.validators.RegexValidator('^(\\d+)/(\\d*)([smhd])$', 'Enter a rate such as "10/m" or "100/5m".')])),
+                ('is_active', models.BooleanField(default=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Rate limit policy',
+                'verbose_name_plural': 'Rate limit policies',
+                'db_table': 'rate_limit_policies',
+            },
+        ),
+    ]
@@ -1,9 +1,19 @@
-from django.db import models
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Q
+from django.db.models.constants import OnConflict
+from django.core.validators import RegexValidator
+from django.utils import timezone
+
+from .rate_policy import RATE_PATTERN
+
+rate_validator = RegexValidator(RATE_PATTERN, 'Enter a rate such as "10/m" or "100/5m".')
 
 class RequestLog(models.Model):
     ip_address = models.GenericIPAddressField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)  # Kept as-is when replayed from the spool
     path = models.CharField(max_length=255)
+    method = models.CharField(max_length=10, blank=True, null=True)
 
     # Geolocation fields
     country = models.CharField(max_length=100, blank=True, null=True)
@@ -26,11 +36,73 @@ class RequestLog(models.Model):
         location = f"{self.city}, {self.country}" if self.city and self.country else "Unknown"
         return f"{self.ip_address} - {location} - {self.path}"
 
+    @classmethod
+    def clip_fields(cls, record):
+        """Truncate the strings of a dict of RequestLog fields to their column lengths"""
+        for field in cls._meta.concrete_fields:
+            value = record.get(field.name)
+            if isinstance(value, str) and field.max_length and len(value) > field.max_length:
+                record[field.name] = value[:field.max_length]
+        return record
+
+
+def _invalidate_blocklist():
+    from .blocklist import invalidate_blocklist
+
+    # After commit, so other processes don't reload the rows being deleted
+    transaction.on_commit(invalidate_blocklist)
+
+
+class BlockedIPQuerySet(models.QuerySet):
+    def delete(self):
+        result = super().delete()
+        _invalidate_blocklist()
+        return result
+
+    def count_blocked(self, ip_addresses, batch_size=1000):
+        """Number of ``ip_addresses`` currently in the blocklist"""
+        return sum(
+            self.filter(ip_address__in=ip_addresses[start:start + batch_size]).count()
+            for start in range(0, len(ip_addresses), batch_size)
+        )
+
+    def block_from(self, source, reason):
+        """
+        Block the distinct ``ip_address`` values of the ``source`` queryset
+        with a single INSERT ... SELECT, skipping IPs already blocked.
+        Returns the number of newly blocked IPs.
+        """
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        sql, params = source.order_by().values('ip_address').distinct().query.sql_with_params()
+        table = quote(self.model._meta.db_table)
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"{connection.ops.insert_statement(on_conflict=OnConflict.IGNORE)} {table} "
+                f"({quote('ip_address')}, {quote('reason')}, {quote('created_at')}) "
+                f"SELECT source.{quote('ip_address')}, %s, %s FROM ({sql}) source "
+                f"WHERE NOT EXISTS (SELECT 1 FROM {table} blocked "
+                f"WHERE blocked.{quote('ip_address')} = source.{quote('ip_address')}) "
+                # IPs blocked concurrently by another writer
+                f"{connection.ops.on_conflict_suffix_sql([], OnConflict.IGNORE, [], [])}",
+                [reason, now, *params],
+            )
+            return cursor.rowcount
+
 
 class BlockedIP(models.Model):
     ip_address = models.GenericIPAddressField(unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
     reason = models.TextField(blank=True, null=True)
+
+    objects = BlockedIPQuerySet.as_manager()
+
+    def delete(self, *args, **kwargs):
+        # Every unblock reaches the snapshots, whichever code path deletes
+        result = super().delete(*args, **kwargs)
+        _invalidate_blocklist()
+        return result
     
     class Meta:
         db_table = 'blocked_ips'
@@ -41,6 +113,51 @@ class BlockedIP(models.Model):
         return f"{self.ip_address} - {self.created_at}"
 
 
+class SuspiciousIPQuerySet(models.QuerySet):
+    def open(self):
+        return self.filter(is_resolved=False)
+
+    def resolve(self):
+        """Resolve every open incident in the queryset with a single UPDATE"""
+        return self.filter(is_resolved=False).update(is_resolved=True, resolved_at=timezone.now())
+
+    def expire(self, idle_for):
+        """Resolve open incidents not seen for ``idle_for`` (a timedelta)"""
+        return self.filter(last_seen__lt=timezone.now() - idle_for).resolve()
+
+    def record(self, ip_address, reason, description, count=1):
+        """
+        Record a detection, collapsing repeats into the open incident for
+        (ip_address, reason). ``count`` is the request count of the current
+        detection window and replaces the stored one: periodic runs re-count
+        overlapping windows, so adding it up would count rows twice.
+        Returns True when a new incident was opened.
+        """
+        now = timezone.now()
+        changes = {
+            'description': description,
+            'request_count': count,
+            'last_seen': now,
+        }
+        open_incident = self.filter(ip_address=ip_address, reason=reason, is_resolved=False)
+        if open_incident.update(**changes):
+            return False
+        try:
+            with transaction.atomic():
+                self.create(
+                    ip_address=ip_address,
+                    reason=reason,
+                    description=description,
+                    request_count=count,
+                    last_seen=now,
+                )
+            return True
+        except IntegrityError:
+            # Another worker opened the incident first
+            open_incident.update(**changes)
+            return False
+
+
 class SuspiciousIP(models.Model):
     REASON_CHOICES = [
         ('high_volume', 'High request volume'),
@@ -54,8 +171,11 @@ class SuspiciousIP(models.Model):
     description = models.TextField()
     request_count = models.IntegerField(default=0)
     detected_at = models.DateTimeField(auto_now_add=True)
+    last_seen = models.DateTimeField(default=timezone.now)
     is_resolved = models.BooleanField(default=False)
     resolved_at = models.DateTimeField(blank=True, null=True)
+
+    objects = SuspiciousIPQuerySet.as_manager()
     
     class Meta:
         db_table = 'suspicious_ips'
@@ -64,6 +184,15 @@ class SuspiciousIP(models.Model):
         indexes = [
             models.Index(fields=['ip_address', 'detected_at']),
             models.Index(fields=['is_resolved']),
+            models.Index(fields=['is_resolved', 'last_seen']),
+        ]
+        constraints = [
+            # At most one open incident per IP and reason
+            models.UniqueConstraint(
+                fields=['ip_address', 'reason'],
+                condition=Q(is_resolved=False),
+                name='unique_open_incident',
+            ),
         ]
     
     def __str__(self):
@@ -71,6 +200,78 @@ class SuspiciousIP(models.Model):
     
     def mark_resolved(self):
         self.is_resolved = True
-        from django.utils import timezone
         self.resolved_at = timezone.now()
-        self.save()
\ No newline at end of file
+        self.save(update_fields=['is_resolved', 'resolved_at'])
+
+
+class DetectionRule(models.Model):
+    """Database-defined detection rule, compiled together with the settings rules"""
+    name = models.CharField(max_length=100, unique=True)
+    reason = models.CharField(max_length=50, choices=SuspiciousIP.REASON_CHOICES)
+    path_prefixes = models.JSONField(default=list, blank=True)
+    path_regexes = models.JSONField(default=list, blank=True)
+    methods = models.JSONField(default=list, blank=True)
+    countries = models.JSONField(default=list, blank=True)
+    threshold = models.PositiveIntegerField(default=0)  # Flag when hits exceed this
+    window_seconds = models.PositiveIntegerField(default=3600)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'detection_rules'
+        verbose_name = 'Detection rule'
+        verbose_name_plural = 'Detection rules'
+
+    def __str__(self):
+        return f"{self.name} ({self.get_reason_display()})"
+
+    def as_config(self):
+        """Rule definition in the format of IP_TRACKING_DETECTION_RULES"""
+        return {
+            'name': self.name,
+            'reason': self.reason,
+            'prefixes': self.path_prefixes or [],
+            'regexes': self.path_regexes or [],
+            'methods': self.methods or [],
+            'countries': self.countries or [],
+            'threshold': self.threshold,
+            'window': self.window_seconds,
+        }
+
+    def clean(self):
+        from .rules import build_rule
+
+        try:
+            build_rule(self.as_config())
+        except ImproperlyConfigured as e:
+            raise ValidationError(str(e))
+
+
+class RateLimitPolicy(models.Model):
+    """Database-defined rate for an endpoint group, overriding RATELIMITS"""
+    group = models.CharField(max_length=100, unique=True)
+    rate = models.CharField(max_length=20, validators=[rate_validator])  # Anonymous clients
+    authenticated_rate = models.CharField(max_length=20, blank=True, validators=[rate_validator])  # Defaults to rate
+    is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'rate_limit_policies'
+        verbose_name = 'Rate limit policy'
+        verbose_name_plural = 'Rate limit policies'
+
+    def __str__(self):
+        return f"{self.group}: {self.rate}"
+
+
+class SpoolCheckpoint(models.Model):
+    """Replay progress of one request-log spool segment"""
+    segment = models.CharField(max_length=255, unique=True)
+    offset = models.BigIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'spool_checkpoints'
+
+    def __str__(self):
+        return f"{self.segment} @ {self.offset}"
@@ -1,29 +1,54 @@
-from django_ratelimit.decorators import ratelimit
+from django.conf import settings
+from django.utils.module_loading import import_string
+from django_ratelimit import ALL
+from django_ratelimit.core import get_usage
+from django_ratelimit.exceptions import Ratelimited
 from functools import wraps
 
-def rate_limit_authenticated(rate='10/m'):
-    """Custom decorator for authenticated users"""
+from .rate_policy import get_rate_policy
+
+def adaptive_ratelimit(group=None, rate=None, authenticated_rate=None, key='ip', method=ALL, block=True):
+    """
+    django-ratelimit's ``ratelimit`` with the limit resolved per request by the
+    rate policy (see ``ip_tracking.rate_policy``). ``rate`` and
+    ``authenticated_rate`` are used when settings and the database don't
+    define the group.
+    """
     def decorator(view_func):
+        limit_group = group or f"{view_func.__module__}.{view_func.__qualname__}"
+
         @wraps(view_func)
         def _wrapped_view(request, *args, **kwargs):
-            # Apply different rates based on authentication
-            if request.user.is_authenticated:
-                # Higher limit for authenticated users
-                return ratelimit(key='user', rate=rate, method='ALL', block=True)(view_func)(request, *args, **kwargs)
-            else:
-                # Lower limit for anonymous users
-                return ratelimit(key='ip', rate='5/m', method='ALL', block=True)(view_func)(request, *args, **kwargs)
+            policy = get_rate_policy()
+            user = getattr(request, 'user', None)
+            authenticated = bool(user and user.is_authenticated)
+            base = policy.base_rate(limit_group, authenticated, rate, authenticated_rate)
+
+            # Count against the base rate, so the counter survives scaling
+            usage = get_usage(request, group=limit_group, key=key, rate=base, method=method, increment=True)
+            limited = False
+            # Below the lowest possible limit the client's reputation can't
+            # matter: skip its lookup, which would cost a query per request
+            # from each new IP in a spoofed-source flood
+            if usage is not None and usage['count'] > policy.min_limit(base[0]):
+                limit = policy.scale(base[0], get_client_ip(request), user if authenticated else None)
+                limited = usage['count'] > limit
+
+            request.limited = limited or getattr(request, 'limited', False)
+            if limited and block:
+                cls = getattr(settings, 'RATELIMIT_EXCEPTION_CLASS', Ratelimited)
+                raise (import_string(cls) if isinstance(cls, str) else cls)()
+            return view_func(request, *args, **kwargs)
         return _wrapped_view
     return decorator
 
-def rate_limit_by_group(group, rate):
+def rate_limit_authenticated(rate='10/m', group=None):
+    """Per-user limit for authenticated users, per-IP default limit for anonymous ones"""
+    return adaptive_ratelimit(group=group, authenticated_rate=rate, key='user_or_ip', method=ALL)
+
+def rate_limit_by_group(group, rate=None):
     """Rate limit by custom groups"""
-    def decorator(view_func):
-        @wraps(view_func)
-        def _wrapped_view(request, *args, **kwargs):
-            return ratelimit(key='ip', rate=rate, method='ALL', block=True, group=group)(view_func)(request, *args, **kwargs)
-        return _wrapped_view
-    return decorator
+    return adaptive_ratelimit(group=group, rate=rate, key='ip', method=ALL)
 
 
 
@@ -0,0 +1,274 @@
+"""
+Adaptive rate-limit policy.
+
+The base limit of an endpoint group is resolved from, first match wins:
+
+1. active ``RateLimitPolicy`` rows;
+2. ``RATELIMITS['groups']`` in settings;
+3. the rate given to the view's decorator;
+4. ``RATELIMITS['default']`` (anonymous) or ``RATELIMITS['authenticated']``.
+
+It is then scaled per request:
+
+* by reputation: clients whose IP has an open ``SuspiciousIP`` incident get
+  ``suspicious_factor``; staff and members of ``trusted_groups`` get
+  ``trusted_factor``;
+* by load: ``LoadMonitor`` tracks in-flight requests and a moving average
+  of response latency in this process. Above ``high_water`` pressure the
+  limits of untrusted clients shrink (down to ``min_load_factor``), and from
+  ``shed_pressure`` on ``IPLoggingMiddleware`` turns suspicious clients away
+  with 503 before they reach a view.
+
+Group rates are compiled once per process and reloaded when the policy
+version changes. Reputation is only looked up for clients whose usage
+reaches ``min_limit()``, the smallest limit any scaling can produce, and is
+cached per IP and per user for ``cache_ttl`` seconds (IP reputations in the
+shared cache as well, so workers don't each query the database).
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+
+RATE_POLICY_VERSION_CACHE_KEY = 'ip_tracking:rate_policy_version'
+REPUTATION_CACHE_PREFIX = 'ip_tracking:suspicious_ip:'
+RATE_PATTERN = r'^(\d+)/(\d*)([smhd])$'
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+SUSPICIOUS = 'suspicious'
+TRUSTED = 'trusted'
+NEUTRAL = 'neutral'
+
+DEFAULT_RATE_POLICY = {
+    'cache_ttl': 60,            # Seconds reputation lookups are cached
+    'cache_size': 10000,        # Cached IPs/users per process
+    'refresh_interval': 10,     # Seconds between policy version checks
+    'suspicious_factor': 0.2,
+    'trusted_factor': 5.0,
+    'trusted_groups': [],       # Auth groups treated as trusted (staff always are)
+    'max_concurrency': 32,      # In-flight requests per process at full load
+    'target_latency': 0.5,      # Seconds; average latency at full load
+    'latency_smoothing': 0.2,   # Weight of the latest request in the average
+    'high_water': 0.8,          # Pressure above which limits shrink
+    'min_load_factor': 0.25,
+    'shed_pressure': 1.0,       # Pressure from which suspicious clients get 503
+}
+
+
+def get_rate_policy_settings():
+    return {**DEFAULT_RATE_POLICY, **getattr(settings, 'IP_TRACKING_RATE_POLICY', {})}
+
+
+def parse_rate(rate):
+    """'10/m' -> (10, 60); '100/5m' -> (100, 300)"""
+    match = re.match(RATE_PATTERN, (rate or '').strip())
+    if match is None:
+        raise ImproperlyConfigured(f"Invalid rate limit {rate!r}")
+    count, multiplier, unit = match.groups()
+    return int(count), PERIODS[unit] * int(multiplier or 1)
+
+
+def _parse_group(rates):
+    """A rate string, or {'anonymous': ..., 'authenticated': ...}"""
+    if isinstance(rates, str):
+        rates = {'anonymous': rates}
+    anonymous = rates.get('anonymous')
+    authenticated = rates.get('authenticated') or anonymous
+    parsed = {}
+    if anonymous:
+        parsed['anonymous'] = parse_rate(anonymous)
+    if authenticated:
+        parsed['authenticated'] = parse_rate(authenticated)
+    return parsed
+
+
+def load_group_rates():
+    """Collect per-group rates from settings and the database"""
+    from .models import RateLimitPolicy
+
+    groups = {
+        group: _parse_group(rates)
+        for group, rates in getattr(settings, 'RATELIMITS', {}).get('groups', {}).items()
+    }
+    for policy in RateLimitPolicy.objects.filter(is_active=True):
+        groups[policy.group] = _parse_group({
+            'anonymous': policy.rate,
+            'authenticated': policy.authenticated_rate,
+        })
+    return groups
+
+
+class LoadMonitor:
+    """In-flight requests and average latency of this process"""
+
+    def __init__(self, max_concurrency=32, target_latency=0.5, smoothing=0.2):
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.smoothing = smoothing
+        self.in_flight = 0
+        self.latency = 0.0
+        self._lock = threading.Lock()
+
+    def started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def finished(self, elapsed):
+        with self._lock:
+            self.in_flight -= 1
+            self.latency += self.smoothing * (elapsed - self.latency)
+
+    def pressure(self):
+        """1.0 means fully loaded, by concurrency or by latency"""
+        return max(self.in_flight / self.max_concurrency, self.latency / self.target_latency)
+
+
+class RatePolicy:
+    def __init__(self, options=None):
+        self.options = options or get_rate_policy_settings()
+        self.load = LoadMonitor(
+            self.options['max_concurrency'],
+            self.options['target_latency'],
+            self.options['latency_smoothing'],
+        )
+        limits = getattr(settings, 'RATELIMITS', {})
+        self.defaults = {
+            'anonymous': parse_rate(limits.get('default', '5/m')),
+            'authenticated': parse_rate(limits.get('authenticated', '10/m')),
+        }
+        self._groups = None
+        self._version = None
+        self._checked_at = None
+        self._reputations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def base_rate(self, group, authenticated, rate=None, authenticated_rate=None):
+        """Return (count, seconds) for the group before any scaling"""
+        kind = 'authenticated' if authenticated else 'anonymous'
+        rates = self._group_rates().get(group, {})
+        if kind in rates:
+            return rates[kind]
+        default = (authenticated_rate or rate) if authenticated else rate
+        if default:
+            return parse_rate(default)
+        return self.defaults[kind]
+
+    def scale(self, count, ip_address, user=None):
+        """Scale a base request count by reputation and current load"""
+        reputation = self.reputation(ip_address, user)
+        if reputation == SUSPICIOUS:
+            factor = self.options['suspicious_factor']
+        elif reputation == TRUSTED:
+            # Trusted clients keep their limit under load
+            return max(1, int(count * self.options['trusted_factor']))
+        else:
+            factor = 1.0
+        return max(1, int(count * factor * self.load_factor()))
+
+    def min_limit(self, count):
+        """Lowest limit scale() can return for ``count``, whatever the reputation and load"""
+        factor = min(
+            self.options['trusted_factor'],
+            min(self.options['suspicious_factor'], 1.0) * self.options['min_load_factor'],
+        )
+        return max(1, int(count * factor))
+
+    def load_factor(self):
+        pressure = self.load.pressure()
+        high_water = self.options['high_water']
+        if pressure <= high_water:
+            return 1.0
+        return max(self.options['min_load_factor'], high_water / pressure)
+
+    def should_shed(self, ip_address):
+        """Turn the client away: overloaded and the IP has an open incident"""
+        if self.load.pressure() < self.options['shed_pressure']:
+            return False
+        return self.reputation(ip_address) == SUSPICIOUS
+
+    def reputation(self, ip_address, user=None):
+        if ip_address and self._cached(('ip', ip_address), self._is_suspicious, ip_address):
+            return SUSPICIOUS
+        if user is not None and user.is_authenticated:
+            if self._cached(('user', user.pk), self._is_trusted, user):
+                return TRUSTED
+        return NEUTRAL
+
+    def _is_suspicious(self, ip_address):
+        from .models import SuspiciousIP
+
+        key = f"{REPUTATION_CACHE_PREFIX}{ip_address}"
+        suspicious = cache.get(key)
+        if suspicious is None:
+            suspicious = SuspiciousIP.objects.open().filter(ip_address=ip_address).exists()
+            cache.set(key, suspicious, self.options['cache_ttl'])
+        return suspicious
+
+    def _is_trusted(self, user):
+        if user.is_staff:
+            return True
+        trusted_groups = self.options['trusted_groups']
+        return bool(trusted_groups) and user.groups.filter(name__in=trusted_groups).exists()
+
+    def _cached(self, key, lookup, argument):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._reputations.get(key)
+            if entry is not None and entry[0] > now:
+                self._reputations.move_to_end(key)
+                return entry[1]
+        value = lookup(argument)
+        with self._lock:
+            self._reputations[key] = (now + self.options['cache_ttl'], value)
+            self._reputations.move_to_end(key)
+            while len(self._reputations) > self.options['cache_size']:
+                self._reputations.popitem(last=False)
+        return value
+
+    def _group_rates(self):
+        now = time.monotonic()
+        checked_at = self._checked_at
+        if checked_at is not None and now - checked_at < self.options['refresh_interval']:
+            return self._groups
+        version = cache.get(RATE_POLICY_VERSION_CACHE_KEY, 0)
+        if self._groups is None or version != self._version:
+            self._groups = load_group_rates()
+            self._version = version
+        self._checked_at = now
+        return self._groups
+
+
+_policy_lock = threading.Lock()
+_policy = None
+
+
+def get_rate_policy():
+    """Return the per-process rate policy"""
+    global _policy
+    if _policy is None:
+        with _policy_lock:
+            if _policy is None:
+                _policy = RatePolicy()
+    return _policy
+
+
+def reset_rate_policy():
+    """Rebuild the policy on next use (used when its settings change)"""
+    global _policy
+    with _policy_lock:
+        _policy = None
+
+
+def invalidate_rate_policy():
+    """Make every process reload group rates on its next version check"""
+    try:
+        cache.incr(RATE_POLICY_VERSION_CACHE_KEY)
+    except ValueError:
+        cache.set(RATE_POLICY_VERSION_CACHE_KEY, 1, None)
+    if _policy is not None:
+        # Reload this process right away
+        _policy._checked_at = None
@@ -0,0 +1,272 @@
+"""
+Detection rule engine.
+
+Rules come from ``settings.IP_TRACKING_DETECTION_RULES`` (by default
+``DEFAULT_DETECTION_RULES``) and from active ``DetectionRule`` rows. They are compiled once into a ``RuleSet``:
+
+* path prefixes go into a single character trie, so matching a path costs
+  O(len(path)) no matter how many prefix rules exist;
+* path regexes are folded into one combined pattern evaluated in a single
+  ``re`` call;
+* country-only rules are indexed by country, and rules without any path or
+  country condition are kept in a small "global" list.
+
+Each request or log row is therefore matched once against all rules.
+"""
+import re
+import threading
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+
+RULES_VERSION_CACHE_KEY = 'ip_tracking:detection_rules_version'
+LEADING_FLAGS = re.compile(r'^\(\?([aimsux]+)\)')
+LIST_FIELDS = ('prefixes', 'regexes', 'methods', 'countries')
+
+DEFAULT_DETECTION_RULES = [
+    {
+        'name': 'high-volume',
+        'reason': 'high_volume',
+        'threshold': 100,
+        'window': 3600,
+    },
+    {
+        'name': 'sensitive-paths',
+        'reason': 'sensitive_access',
+        'prefixes': ['/admin', '/login'],
+        'threshold': 0,
+        'window': 3600,
+    },
+]
+
+
+class Rule:
+    """A single compiled detection rule"""
+
+    def __init__(self, name, reason, prefixes=(), regexes=(), methods=(),
+                 countries=(), threshold=0, window=3600):
+        self.name = name
+        self.reason = reason
+        self.prefixes = tuple(prefixes)
+        self.regexes = tuple(regexes)
+        self.methods = frozenset(m.upper() for m in methods)
+        self.countries = frozenset(c.upper() for c in countries)
+        self.threshold = int(threshold)
+        self.window = int(window)
+
+    @property
+    def has_path_condition(self):
+        return bool(self.prefixes or self.regexes)
+
+    def accepts(self, method, countries):
+        """Check the non-path conditions of the rule (``countries``: upper-cased code and name)"""
+        if self.methods and (method or '').upper() not in self.methods:
+            return False
+        if self.countries and self.countries.isdisjoint(countries):
+            return False
+        return True
+
+    def __repr__(self):
+        return f"<Rule {self.name} ({self.reason})>"
+
+
+class PrefixTrie:
+    """Character trie mapping path prefixes to the rule ids that own them"""
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, prefix, rule_id):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append(rule_id)
+
+    def match(self, path):
+        """Return ids of all rules with a prefix of ``path``"""
+        hits = []
+        node = self.root
+        if None in node:
+            hits.extend(node[None])
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                hits.extend(node[None])
+        return hits
+
+
+class RuleSet:
+    """All active rules compiled for single-pass matching"""
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.trie = PrefixTrie()
+        self.by_country = {}
+        self.global_ids = []
+        self.regex_group_ids = {}
+
+        regex_parts = []
+        for rule_id, rule in enumerate(self.rules):
+            for prefix in rule.prefixes:
+                self.trie.add(prefix, rule_id)
+            for index, pattern in enumerate(rule.regexes):
+                group = f"_r{rule_id}_{index}"
+                self.regex_group_ids[group] = rule_id
+                regex_parts.append(lookahead(group, pattern))
+            if not rule.has_path_condition:
+                if rule.countries:
+                    for country in rule.countries:
+                        self.by_country.setdefault(country, []).append(rule_id)
+                else:
+                    self.global_ids.append(rule_id)
+
+        self.combined_regex = re.compile(''.join(regex_parts), re.DOTALL) if regex_parts else None
+        self.max_window = max((rule.window for rule in self.rules), default=0)
+
+    def match(self, path, method=None, country=None, country_code=None):
+        """
+        Return the rules matching a request or log row. Rule countries are
+        compared with both the country name and the ISO code.
+        """
+        countries = {value.upper() for value in (country, country_code) if value}
+        candidate_ids = set(self.global_ids)
+        candidate_ids.update(self.trie.match(path or ''))
+        if self.combined_regex is not None:
+            groups = self.combined_regex.match(path or '').groupdict()
+            candidate_ids.update(
+                self.regex_group_ids[group] for group, value in groups.items()
+                if value is not None and group in self.regex_group_ids
+            )
+        for value in countries:
+            candidate_ids.update(self.by_country.get(value, ()))
+
+        return [
+            self.rules[rule_id] for rule_id in sorted(candidate_ids)
+            if self.rules[rule_id].accepts(method, countries)
+        ]
+
+
+def lookahead(group, pattern):
+    """
+    Wrap a pattern for the combined regex: each one is an optional lookahead
+    at position 0, so a single match() reports every pattern that hits the
+    path.
+    """
+    return f"(?:(?=.*?(?P<{group}>{pattern})))?"
+
+
+def _has_group_reference(parsed):
+    for op, av in parsed:
+        if str(op).startswith('GROUPREF'):
+            return True
+        for item in av if isinstance(av, (list, tuple)) else (av,):
+            if isinstance(item, sre_parse.SubPattern) and _has_group_reference(item):
+                return True
+            if isinstance(item, (list, tuple)) and any(
+                isinstance(sub, sre_parse.SubPattern) and _has_group_reference(sub) for sub in item
+            ):
+                return True
+    return False
+
+
+def compile_regex(name, pattern):
+    """
+    Check that a rule regex works inside the combined pattern. Leading inline
+    flags such as ``(?i)`` become a scoped group; group names and
+    backreferences would clash or shift once combined and are rejected.
+    Returns the pattern to combine.
+    """
+    if not isinstance(pattern, str):
+        raise ImproperlyConfigured(f"Detection rule {name!r} has non-string regex {pattern!r}")
+    flags = LEADING_FLAGS.match(pattern)
+    if flags:
+        pattern = f"(?{flags.group(1)}:{pattern[flags.end():]})"
+    try:
+        compiled = re.compile(pattern)
+        if compiled.groupindex or _has_group_reference(sre_parse.parse(pattern)):
+            raise ImproperlyConfigured(
+                f"Detection rule {name!r} regex {pattern!r} uses named groups or "
+                f"backreferences, which are not supported"
+            )
+        re.compile(lookahead('_check', pattern))
+    except re.error as e:
+        raise ImproperlyConfigured(f"Detection rule {name!r} has invalid regex {pattern!r}: {e}")
+    return pattern
+
+
+def build_rule(config):
+    """Validate a rule definition (dict) and build a ``Rule``"""
+    from .models import SuspiciousIP
+
+    valid_reasons = {choice for choice, _ in SuspiciousIP.REASON_CHOICES}
+    name = config.get('name')
+    reason = config.get('reason')
+    if not name:
+        raise ImproperlyConfigured("Detection rules require a 'name'")
+    if reason not in valid_reasons:
+        raise ImproperlyConfigured(
+            f"Detection rule {name!r} has invalid reason {reason!r}; "
+            f"expected one of {sorted(valid_reasons)}"
+        )
+    for field in LIST_FIELDS:
+        values = config.get(field, ())
+        if not isinstance(values, (list, tuple)) or not all(isinstance(v, str) and v for v in values):
+            raise ImproperlyConfigured(
+                f"Detection rule {name!r}: {field!r} must be a list of non-empty strings"
+            )
+
+    return Rule(
+        name=name,
+        reason=reason,
+        prefixes=config.get('prefixes', ()),
+        regexes=[compile_regex(name, pattern) for pattern in config.get('regexes', ())],
+        methods=config.get('methods', ()),
+        countries=config.get('countries', ()),
+        threshold=config.get('threshold', 0),
+        window=config.get('window', 3600),
+    )
+
+
+def load_rules():
+    """Collect rule definitions from settings and the database"""
+    from .models import DetectionRule
+
+    configs = getattr(settings, 'IP_TRACKING_DETECTION_RULES', DEFAULT_DETECTION_RULES)
+    rules = [build_rule(config) for config in configs]
+    for db_rule in DetectionRule.objects.filter(is_active=True).order_by('id'):
+        try:
+            rules.append(build_rule(db_rule.as_config()))
+        except ImproperlyConfigured as e:
+            # A bad row must not take down the settings rules and the other rows
+            print(f"Skipping detection rule {db_rule.name!r}: {e}")
+    return rules
+
+
+_lock = threading.Lock()
+_compiled = {'version': None, 'ruleset': None}
+
+
+def get_ruleset():
+    """Return the compiled rule set, recompiling when the rules change"""
+    version = cache.get(RULES_VERSION_CACHE_KEY, 0)
+    with _lock:
+        if _compiled['ruleset'] is None or _compiled['version'] != version:
+            _compiled['ruleset'] = RuleSet(load_rules())
+            _compiled['version'] = version
+        return _compiled['ruleset']
+
+
+def invalidate_ruleset():
+    """Signal every process to recompile its rule set"""
+    try:
+        cache.incr(RULES_VERSION_CACHE_KEY)
+    except ValueError:
+        cache.set(RULES_VERSION_CACHE_KEY, 1, None)
@@ -0,0 +1,51 @@
+from rest_framework import serializers
+
+from .models import BlockedIP, SuspiciousIP
+
+MAX_BULK_ITEMS = 10000
+
+
+class BlockedIPSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = BlockedIP
+        fields = ['id', 'ip_address', 'reason', 'created_at']
+        read_only_fields = ['id', 'created_at']
+
+
+class BulkBlockedIPSerializer(BlockedIPSerializer):
+    class Meta(BlockedIPSerializer.Meta):
+        # Duplicates are skipped on bulk insert; the default UniqueValidator
+        # would cost one query per row.
+        extra_kwargs = {'ip_address': {'validators': []}}
+
+
+class SuspiciousIPSerializer(serializers.ModelSerializer):
+    reason_display = serializers.CharField(source='get_reason_display', read_only=True)
+
+    class Meta:
+        model = SuspiciousIP
+        fields = [
+            'id', 'ip_address', 'reason', 'reason_display', 'description',
+            'request_count', 'detected_at', 'last_seen', 'is_resolved', 'resolved_at',
+        ]
+        read_only_fields = fields
+
+
+class IPAddressListSerializer(serializers.Serializer):
+    ip_addresses = serializers.ListField(
+        child=serializers.IPAddressField(), allow_empty=False, max_length=MAX_BULK_ITEMS
+    )
+
+
+class BulkResolveSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.IntegerField(), required=False, max_length=MAX_BULK_ITEMS
+    )
+    ip_addresses = serializers.ListField(
+        child=serializers.IPAddressField(), required=False, max_length=MAX_BULK_ITEMS
+    )
+
+    def validate(self, attrs):
+        if not attrs.get('ids') and not attrs.get('ip_addresses'):
+            raise serializers.ValidationError("Provide 'ids' and/or 'ip_addresses'.")
+        return attrs
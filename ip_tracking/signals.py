@@ -0,0 +1,65 @@
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .blocklist import invalidate_blocklist
+from .geo_client import reset_provider_client
+from .geo_policy import reset_geo_policy
+from .geolocation import reset_geo_index
+from .models import BlockedIP, DetectionRule, RateLimitPolicy
+from .rate_policy import invalidate_rate_policy, reset_rate_policy
+from .rules import invalidate_ruleset
+from .sketches import reset_sketch_recorder
+
+
+@receiver([post_save, post_delete], sender=DetectionRule)
+def detection_rules_changed(sender, **kwargs):
+    """Recompile detection rules in every process after a change"""
+    invalidate_ruleset()
+
+
+@receiver([post_save, post_delete], sender=RateLimitPolicy)
+def rate_limit_policies_changed(sender, **kwargs):
+    """Reload group rates in every process after a change"""
+    invalidate_rate_policy()
+
+
+@receiver(post_save, sender=BlockedIP)
+def blocked_ip_saved(sender, **kwargs):
+    """Reload blocklist snapshots after a block is added or changed"""
+    # Deletes are covered by BlockedIP.delete() and its queryset: a
+    # post_delete receiver would make bulk queryset deletes fetch every row.
+    invalidate_blocklist()
+
+
+@receiver(setting_changed)
+def detection_settings_changed(setting, **kwargs):
+    """Recompile detection rules when the settings rules change"""
+    if setting == 'IP_TRACKING_DETECTION_RULES':
+        invalidate_ruleset()
+
+
+@receiver(setting_changed)
+def geo_settings_changed(setting, **kwargs):
+    """Rebuild geolocation components when their settings change"""
+    if setting == 'IP_TRACKING_GEO_INDEX_PATH':
+        reset_geo_index()
+        reset_geo_policy()
+    elif setting == 'IP_TRACKING_GEO_POLICY':
+        reset_geo_policy()
+    elif setting in ('IP_TRACKING_GEO_PROVIDER', 'IPGEOLOCATION_API_KEY'):
+        reset_provider_client()
+
+
+@receiver(setting_changed)
+def sketch_settings_changed(setting, **kwargs):
+    """Start new traffic sketches when their settings change"""
+    if setting == 'IP_TRACKING_SKETCHES':
+        reset_sketch_recorder()
+
+
+@receiver(setting_changed)
+def rate_policy_settings_changed(setting, **kwargs):
+    """Rebuild the rate policy when its settings change"""
+    if setting in ('RATELIMITS', 'IP_TRACKING_RATE_POLICY'):
+        reset_rate_policy()
@@ -0,0 +1,429 @@
+"""
+Fixed-memory traffic sketches.
+
+* ``CountMinSketch``: per-IP request counts (over-estimates only).
+* ``SpaceSaving``: the top-k heavy-hitter IPs.
+* ``HyperLogLog``: distinct IPs overall, per top-level path segment and per
+  country.
+
+All three are mergeable. ``IPLoggingMiddleware`` feeds a per-process
+``SketchSet`` for the current time bucket. ``SketchRecorder`` writes it to
+Redis from a background thread as one compact blob: hash ``<prefix>:<bucket start>``,
+field ``<host>-<pid>``. Readers merge every worker's blob for the buckets
+they need with ``load_sketches()``, so memory stays fixed no matter how many
+source IPs an attacker rotates through.
+"""
+import hashlib
+import heapq
+import json
+import math
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+from array import array
+
+from django.conf import settings
+
+DEFAULT_SKETCHES = {
+    'enabled': True,
+    'redis_url': None,          # Defaults to the default cache's LOCATION
+    'key_prefix': 'ip_tracking:sketch',
+    'bucket_seconds': 300,
+    'retention': 2 * 3600,      # Seconds buckets are kept in Redis
+    'flush_interval': 5,        # Seconds between flushes per worker
+    'socket_timeout': 0.5,      # Seconds; Redis connect and command timeout
+    'cms_width': 4096,
+    'cms_depth': 4,
+    'top_k': 200,
+    'hll_precision': 14,        # Distinct IPs overall (~0.8% error)
+    'group_hll_precision': 10,  # Per path segment / country (~3% error)
+    'max_groups': 256,          # Extra path segments/countries share '__other__'
+}
+OTHER_GROUP = '__other__'
+
+
+def get_sketch_settings():
+    return {**DEFAULT_SKETCHES, **getattr(settings, 'IP_TRACKING_SKETCHES', {})}
+
+
+def hash64(key):
+    """Stable 64-bit hash (identical in every worker, unlike hash())"""
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _to_le_bytes(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_le_bytes(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class CountMinSketch:
+    HEADER = struct.Struct('<II')
+
+    def __init__(self, width=4096, depth=4, counters=None):
+        self.width = width
+        self.depth = depth
+        self.counters = counters if counters is not None else array('I', bytes(4 * width * depth))
+
+    def _cells(self, key):
+        h = hash64(key)
+        h1, h2 = h & 0xFFFFFFFF, h >> 32
+        return [row * self.width + (h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, key, count=1):
+        """Add ``count`` to ``key`` and return its new estimate"""
+        estimate = 0xFFFFFFFF
+        for cell in self._cells(key):
+            value = self.counters[cell] = min(self.counters[cell] + count, 0xFFFFFFFF)
+            estimate = min(estimate, value)
+        return estimate
+
+    def estimate(self, key):
+        return min(self.counters[cell] for cell in self._cells(key))
+
+    def merge(self, other):
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError("Cannot merge count-min sketches of different shapes")
+        for cell, value in enumerate(other.counters):
+            if value:
+                self.counters[cell] = min(self.counters[cell] + value, 0xFFFFFFFF)
+
+    def to_bytes(self):
+        return self.HEADER.pack(self.width, self.depth) + _to_le_bytes(self.counters)
+
+    @classmethod
+    def from_bytes(cls, data):
+        width, depth = cls.HEADER.unpack_from(data)
+        return cls(width, depth, _from_le_bytes('I', data[cls.HEADER.size:]))
+
+
+class SpaceSaving:
+    """
+    Space-Saving top-k summary: {key: (count, error)} with at most ``capacity`` keys.
+
+    Eviction finds the smallest counter through a lazy min-heap holding one
+    (count, key) entry per key. Counts only grow, so entries are lower
+    bounds: increments leave the heap alone, and a stale entry popped during
+    eviction is pushed back with its current count. Adding a key therefore
+    costs O(log k) amortized instead of a scan of every counter.
+    """
+
+    def __init__(self, capacity=200):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self._heap = []
+
+    def add(self, key, count=1):
+        if key in self.counts:
+            self.counts[key] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = count
+            self.errors[key] = 0
+            heapq.heappush(self._heap, (count, key))
+        else:
+            # Replace the smallest counter; the newcomer inherits its count
+            victim = self._pop_smallest()
+            floor = self.counts.pop(victim)
+            del self.errors[victim]
+            self.counts[key] = floor + count
+            self.errors[key] = floor
+            heapq.heappush(self._heap, (floor + count, key))
+
+    def _pop_smallest(self):
+        while True:
+            count, key = heapq.heappop(self._heap)
+            if self.counts[key] == count:
+                return key
+            heapq.heappush(self._heap, (self.counts[key], key))
+
+    def _rebuild_heap(self):
+        self._heap = [(count, key) for key, count in self.counts.items()]
+        heapq.heapify(self._heap)
+
+    def _floor(self):
+        return min(self.counts.values()) if len(self.counts) >= self.capacity else 0
+
+    def merge(self, other):
+        floor, other_floor = self._floor(), other._floor()
+        counts, errors = {}, {}
+        for key in self.counts.keys() | other.counts.keys():
+            counts[key] = self.counts.get(key, floor) + other.counts.get(key, other_floor)
+            errors[key] = self.errors.get(key, floor) + other.errors.get(key, other_floor)
+        kept = sorted(counts, key=counts.__getitem__, reverse=True)[:self.capacity]
+        self.counts = {key: counts[key] for key in kept}
+        self.errors = {key: errors[key] for key in kept}
+        self._rebuild_heap()
+
+    def top(self, k=None):
+        """[(key, count, error), ...] largest first; count - error is a lower bound"""
+        keys = sorted(self.counts, key=self.counts.__getitem__, reverse=True)[:k]
+        return [(key, self.counts[key], self.errors[key]) for key in keys]
+
+    def to_bytes(self):
+        return json.dumps([self.capacity, self.top()], separators=(',', ':')).encode('utf-8')
+
+    @classmethod
+    def from_bytes(cls, data):
+        capacity, entries = json.loads(data)
+        summary = cls(capacity)
+        for key, count, error in entries:
+            summary.counts[key] = count
+            summary.errors[key] = error
+        summary._rebuild_heap()
+        return summary
+
+
+class HyperLogLog:
+    HEADER = struct.Struct('<B')
+
+    def __init__(self, precision=14, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = registers if registers is not None else bytearray(self.size)
+
+    def add(self, key):
+        h = hash64(key)
+        index = h >> (64 - self.precision)
+        remainder = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remainder.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Small-range correction (linear counting)
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def merge(self, other):
+        if self.precision != other.precision:
+            raise ValueError("Cannot merge HyperLogLogs of different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def to_bytes(self):
+        return self.HEADER.pack(self.precision) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        (precision,) = cls.HEADER.unpack_from(data)
+        return cls(precision, bytearray(data[cls.HEADER.size:]))
+
+
+class SketchSet:
+    """All traffic sketches for one time bucket"""
+
+    def __init__(self, options=None):
+        options = options or get_sketch_settings()
+        self.options = options
+        self.requests = CountMinSketch(options['cms_width'], options['cms_depth'])
+        self.heavy_hitters = SpaceSaving(options['top_k'])
+        self.distinct_ips = HyperLogLog(options['hll_precision'])
+        self.groups = {'path': {}, 'country': {}}
+
+    def record(self, ip_address, path, country=None):
+        self.requests.add(ip_address)
+        self.heavy_hitters.add(ip_address)
+        self.distinct_ips.add(ip_address)
+        self._group('path', path_segment(path)).add(ip_address)
+        self._group('country', country or 'unknown').add(ip_address)
+
+    def _group(self, kind, key):
+        groups = self.groups[kind]
+        if key not in groups and len(groups) >= self.options['max_groups']:
+            key = OTHER_GROUP
+        if key not in groups:
+            groups[key] = HyperLogLog(self.options['group_hll_precision'])
+        return groups[key]
+
+    def merge(self, other):
+        self.requests.merge(other.requests)
+        self.heavy_hitters.merge(other.heavy_hitters)
+        self.distinct_ips.merge(other.distinct_ips)
+        for kind, groups in other.groups.items():
+            for key, hll in groups.items():
+                self._group(kind, key).merge(hll)
+
+    def to_bytes(self):
+        sections = {
+            'requests': self.requests.to_bytes(),
+            'heavy_hitters': self.heavy_hitters.to_bytes(),
+            'distinct_ips': self.distinct_ips.to_bytes(),
+        }
+        for kind, groups in self.groups.items():
+            for key, hll in groups.items():
+                sections[f'{kind}:{key}'] = hll.to_bytes()
+        index = json.dumps([[name, len(data)] for name, data in sections.items()]).encode('utf-8')
+        return struct.pack('<I', len(index)) + index + b''.join(sections.values())
+
+    @classmethod
+    def from_bytes(cls, data, options=None):
+        sketch_set = cls(options)
+        (index_length,) = struct.unpack_from('<I', data)
+        offset = 4 + index_length
+        for name, length in json.loads(data[4:offset]):
+            section = data[offset:offset + length]
+            offset += length
+            if name == 'requests':
+                sketch_set.requests = CountMinSketch.from_bytes(section)
+            elif name == 'heavy_hitters':
+                sketch_set.heavy_hitters = SpaceSaving.from_bytes(section)
+            elif name == 'distinct_ips':
+                sketch_set.distinct_ips = HyperLogLog.from_bytes(section)
+            else:
+                kind, key = name.split(':', 1)
+                sketch_set.groups[kind][key] = HyperLogLog.from_bytes(section)
+        return sketch_set
+
+
+def path_segment(path):
+    """'/admin/auth/user/' -> '/admin'"""
+    segment = (path or '/').lstrip('/').split('/', 1)[0]
+    return f'/{segment}'
+
+
+def get_redis(options):
+    import redis
+
+    url = options['redis_url']
+    if not url:
+        # The cache LOCATION may list replicas; the first one is the primary
+        location = settings.CACHES['default']['LOCATION']
+        url = location[0] if isinstance(location, (list, tuple)) else location.split(',')[0]
+    return redis.Redis.from_url(
+        url,
+        socket_timeout=options['socket_timeout'],
+        socket_connect_timeout=options['socket_timeout'],
+    )
+
+
+class SketchRecorder:
+    """
+    Per-process sketches for the current bucket. Requests only update memory;
+    a daemon thread writes the sketches to Redis every ``flush_interval``.
+    """
+
+    def __init__(self, options=None):
+        self.options = options or get_sketch_settings()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._redis = None
+        self._bucket = None
+        self._sketches = None
+        self._finished = []  # [(bucket, SketchSet)] of past buckets not yet flushed
+        self._stop = threading.Event()
+
+    def record(self, ip_address, path, country=None):
+        bucket_seconds = self.options['bucket_seconds']
+        bucket = int(time.time() // bucket_seconds) * bucket_seconds
+        with self._lock:
+            if self._pid != os.getpid():
+                # First use, or a forked child (which has no flush thread):
+                # start from empty sketches under this process's own field
+                self._pid = os.getpid()
+                self._redis = None
+                self._bucket, self._sketches, self._finished = None, None, []
+                threading.Thread(target=self._run, name='sketch-flush', daemon=True).start()
+            if bucket != self._bucket:
+                if self._sketches is not None:
+                    self._finished.append((self._bucket, self._sketches))
+                self._bucket, self._sketches = bucket, SketchSet(self.options)
+            self._sketches.record(ip_address, path, country)
+
+    def _run(self):
+        while not self._stop.wait(self.options['flush_interval']):
+            self.flush()
+
+    def close(self):
+        """Stop the flush thread after a last flush"""
+        self._stop.set()
+        self.flush()
+
+    def flush(self):
+        """Write finished buckets and the current one to Redis"""
+        with self._lock:
+            finished, self._finished = self._finished, []
+            current = [(self._bucket, self._sketches)] if self._sketches is not None else []
+            # Serialized under the lock, so no request updates them meanwhile
+            blobs = [(bucket, sketches.to_bytes()) for bucket, sketches in finished + current]
+            pid = self._pid
+        if not blobs:
+            return
+        try:
+            if self._redis is None:
+                self._redis = get_redis(self.options)
+            pipeline = self._redis.pipeline(transaction=False)
+            for bucket, blob in blobs:
+                key = f"{self.options['key_prefix']}:{bucket}"
+                # Blobs are cumulative per bucket, so overwriting is idempotent
+                pipeline.hset(key, f"{socket.gethostname()}-{pid}", blob)
+                pipeline.expire(key, self.options['retention'])
+            pipeline.execute()
+        except Exception as e:
+            print(f"Error flushing traffic sketches: {e}")
+            with self._lock:
+                # Retry finished buckets next time, keeping only those still retained
+                keep = self.options['retention'] // self.options['bucket_seconds']
+                self._finished = (finished + self._finished)[-keep:]
+
+
+_recorder_lock = threading.Lock()
+_recorder = None
+
+
+def get_sketch_recorder():
+    """Return the per-process recorder, or None when sketches are disabled"""
+    global _recorder
+    if _recorder is None:
+        options = get_sketch_settings()
+        if not options['enabled']:
+            return None
+        with _recorder_lock:
+            if _recorder is None:
+                _recorder = SketchRecorder(options)
+    return _recorder
+
+
+def reset_sketch_recorder():
+    """Flush and drop the recorder (used when its settings change)"""
+    global _recorder
+    with _recorder_lock:
+        if _recorder is not None:
+            _recorder.close()
+        _recorder = None
+
+
+def load_sketches(seconds, options=None):
+    """Merge every worker's sketches for the buckets covering the last ``seconds``"""
+    options = options or get_sketch_settings()
+    bucket_seconds = options['bucket_seconds']
+    now = time.time()
+    last = int(now // bucket_seconds) * bucket_seconds
+    first = int((now - seconds) // bucket_seconds) * bucket_seconds
+
+    client = get_redis(options)
+    pipeline = client.pipeline(transaction=False)
+    for bucket in range(first, last + 1, bucket_seconds):
+        pipeline.hvals(f"{options['key_prefix']}:{bucket}")
+
+    merged = SketchSet(options)
+    for blobs in pipeline.execute():
+        for blob in blobs:
+            merged.merge(SketchSet.from_bytes(blob, options))
+    return merged
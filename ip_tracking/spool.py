@@ -0,0 +1,386 @@
+"""
+Append-only request-log spool.
+
+When the database cannot absorb the logging rate (or is down),
+``IPLoggingMiddleware`` appends ``RequestLog`` records to local segment
+files instead; ``replay_spool`` later loads them with ``bulk_create``.
+
+Segment layout::
+
+    b'IPSPOOL1'                                  file magic
+    [>I length][>I crc32][payload] ...           one frame per record
+
+    payload = >d timestamp, >B ip version, 16s packed ip,
+              >d latitude, >d longitude          (NaN when unknown)
+              >H-prefixed UTF-8: path, method, country, city, region
+              >I-prefixed UTF-8: geolocation_data as JSON
+
+Writers append to ``<host>-<pid>-<time>-<seq>.open`` and rename the file to
+``.seg`` once it is full or old enough; only sealed segments are replayed.
+A maintenance thread per writer seals the segment on age and fsyncs it on
+``fsync_interval`` even when no more records arrive, and the process's
+writer is closed (sealed) at exit. Replay also seals ``.open`` files whose
+writer process is gone; a writer that finds its file sealed by someone else
+starts a new segment. fsync is batched (every ``fsync_every`` records or
+``fsync_interval`` seconds). Replay progress is stored in ``SpoolCheckpoint`` in the same
+transaction as the inserted rows, and one replay at a time runs per
+directory (``flock`` on ``.replay.lock``), so each record is loaded once.
+Segments the database rejects are renamed to ``.failed`` and skipped.
+"""
+import atexit
+import fcntl
+import ipaddress
+import json
+import math
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+from pathlib import Path
+
+from django.conf import settings
+from django.db import DataError, IntegrityError, transaction
+
+SEGMENT_MAGIC = b'IPSPOOL1'
+OPEN_SUFFIX = '.open'
+SEALED_SUFFIX = '.seg'
+FAILED_SUFFIX = '.failed'
+REPLAY_LOCK = '.replay.lock'
+VERIFY_INTERVAL = 1.0  # Seconds between checks that the open segment still exists
+
+FRAME = struct.Struct('>II')
+HEADER = struct.Struct('>dB16sdd')
+SHORT_LEN = struct.Struct('>H')
+LONG_LEN = struct.Struct('>I')
+
+DEFAULT_SPOOL = {
+    'directory': None,
+    'segment_bytes': 64 * 1024 * 1024,
+    'segment_age': 60,        # Seal open segments after this many seconds
+    'fsync_every': 256,       # Records per fsync
+    'fsync_interval': 1.0,    # Max seconds between fsyncs
+    'stale_after': 300,       # Replay seals .open files untouched this long
+}
+
+
+def get_spool_settings():
+    return {**DEFAULT_SPOOL, **getattr(settings, 'IP_TRACKING_SPOOL', {})}
+
+
+def _pack_str(value, length_struct):
+    data = (value or '').encode('utf-8')[:256 ** length_struct.size - 1]
+    return length_struct.pack(len(data)) + data
+
+
+def _unpack_str(payload, offset, length_struct):
+    (length,) = length_struct.unpack_from(payload, offset)
+    offset += length_struct.size
+    return payload[offset:offset + length].decode('utf-8', 'replace'), offset + length
+
+
+def _float_or_nan(value):
+    return float(value) if value is not None else math.nan
+
+
+def encode_record(record):
+    """Encode a dict of RequestLog fields into one frame"""
+    ip = ipaddress.ip_address(record['ip_address'])
+    payload = b''.join([
+        HEADER.pack(
+            record['timestamp'].timestamp(),
+            ip.version,
+            ip.packed.rjust(16, b'\0'),
+            _float_or_nan(record.get('latitude')),
+            _float_or_nan(record.get('longitude')),
+        ),
+        _pack_str(record.get('path'), SHORT_LEN),
+        _pack_str(record.get('method'), SHORT_LEN),
+        _pack_str(record.get('country'), SHORT_LEN),
+        _pack_str(record.get('city'), SHORT_LEN),
+        _pack_str(record.get('region'), SHORT_LEN),
+        _pack_str(json.dumps(record.get('geolocation_data'), default=str), LONG_LEN),
+    ])
+    return FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_record(payload):
+    """Decode a frame payload back into a dict of RequestLog fields"""
+    timestamp, version, packed_ip, latitude, longitude = HEADER.unpack_from(payload, 0)
+    ip = ipaddress.ip_address(packed_ip[-4:] if version == 4 else packed_ip)
+    offset = HEADER.size
+    strings = []
+    for _ in range(5):
+        value, offset = _unpack_str(payload, offset, SHORT_LEN)
+        strings.append(value)
+    geolocation_json, offset = _unpack_str(payload, offset, LONG_LEN)
+    path, method, country, city, region = strings
+    return {
+        'timestamp': datetime.fromtimestamp(timestamp, tz=dt_timezone.utc),
+        'ip_address': str(ip),
+        'path': path,
+        'method': method or None,
+        'country': country or None,
+        'city': city or None,
+        'region': region or None,
+        'latitude': None if math.isnan(latitude) else Decimal(str(round(latitude, 6))),
+        'longitude': None if math.isnan(longitude) else Decimal(str(round(longitude, 6))),
+        'geolocation_data': json.loads(geolocation_json) if geolocation_json else None,
+    }
+
+
+def iter_records(path, offset=len(SEGMENT_MAGIC)):
+    """
+    Yield (next_offset, record) for each complete frame from ``offset``.
+
+    Stops at the first torn or corrupt frame, which can only be the tail of
+    a segment whose writer crashed.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+            raise ValueError(f"{path} is not a spool segment")
+        f.seek(offset)
+        while True:
+            frame = f.read(FRAME.size)
+            if len(frame) < FRAME.size:
+                return
+            length, checksum = FRAME.unpack(frame)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                return
+            offset += FRAME.size + length
+            yield offset, decode_record(payload)
+
+
+class SpoolWriter:
+    """Thread-safe appender for one process; reopens a segment after fork"""
+
+    def __init__(self, directory, segment_bytes=DEFAULT_SPOOL['segment_bytes'],
+                 segment_age=DEFAULT_SPOOL['segment_age'],
+                 fsync_every=DEFAULT_SPOOL['fsync_every'],
+                 fsync_interval=DEFAULT_SPOOL['fsync_interval'], **kwargs):
+        self.directory = Path(directory)
+        self.segment_bytes = segment_bytes
+        self.segment_age = segment_age
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+        self._sequence = 0
+        self._stop = None
+        self._maintained_pid = None
+
+    def append(self, record):
+        frame = encode_record(record)
+        with self._lock:
+            now = time.monotonic()
+            if self._file is None or self._pid != os.getpid():
+                self._open_segment(now)
+            elif now - self._verified_at >= VERIFY_INTERVAL and not self._path.exists():
+                # Sealed by seal_stale_segments() on another host while idle
+                self._file.close()
+                self._open_segment(now)
+            elif self._size >= self.segment_bytes or now - self._opened_at >= self.segment_age:
+                self._seal_segment()
+                self._open_segment(now)
+            self._verified_at = now
+
+            self._file.write(frame)
+            self._size += len(frame)
+            self._pending += 1
+            if self._pending >= self.fsync_every or now - self._synced_at >= self.fsync_interval:
+                self._sync(now)
+
+    def maintain(self):
+        """Seal the segment once old enough and fsync pending records, without waiting for an append"""
+        with self._lock:
+            if self._file is None or self._pid != os.getpid():
+                return
+            now = time.monotonic()
+            if now - self._opened_at >= self.segment_age:
+                self._seal_segment()
+            elif self._pending and now - self._synced_at >= self.fsync_interval:
+                self._sync(now)
+
+    def close(self):
+        with self._lock:
+            if self._stop is not None:
+                self._stop.set()
+            self._maintained_pid = None
+            if self._file is not None and self._pid == os.getpid():
+                self._seal_segment()
+            self._file = None
+
+    def _start_maintenance(self):
+        # Threads don't survive fork: each process starts its own
+        if self._maintained_pid == self._pid:
+            return
+        self._maintained_pid = self._pid
+        self._stop = stop = threading.Event()
+        interval = min(self.fsync_interval, self.segment_age)
+
+        def run():
+            while not stop.wait(interval):
+                self.maintain()
+
+        threading.Thread(target=run, name='spool-maintenance', daemon=True).start()
+
+    def _open_segment(self, now):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if self._pid != os.getpid():
+            # Forked child: never write to the parent's segment
+            if self._file is not None:
+                self._file.close()
+            self._pid = os.getpid()
+            self._sequence = 0
+        self._sequence += 1
+        name = f"{socket.gethostname()}-{self._pid}-{int(time.time())}-{self._sequence:06d}"
+        self._path = self.directory / f"{name}{OPEN_SUFFIX}"
+        # Unbuffered: every append is one write(2), and a forked child
+        # holds no unflushed copy of the parent's data
+        self._file = open(self._path, 'ab', buffering=0)
+        self._file.write(SEGMENT_MAGIC)
+        self._size = len(SEGMENT_MAGIC)
+        self._opened_at = now
+        self._synced_at = now
+        self._verified_at = now
+        self._pending = 0
+        self._start_maintenance()
+
+    def _sync(self, now):
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._synced_at = now
+
+    def _seal_segment(self):
+        self._sync(time.monotonic())
+        self._file.close()
+        self._file = None
+        try:
+            os.replace(self._path, self._path.with_suffix(SEALED_SUFFIX))
+        except FileNotFoundError:
+            # Already sealed by seal_stale_segments()
+            pass
+
+
+_writer_lock = threading.Lock()
+_writer = None
+
+
+def get_spool_writer():
+    """Return the per-process writer, or None when no spool directory is configured"""
+    global _writer
+    if _writer is None:
+        options = get_spool_settings()
+        if not options['directory']:
+            return None
+        with _writer_lock:
+            if _writer is None:
+                _writer = SpoolWriter(**options)
+                # Seal the last segment so replay picks it up
+                atexit.register(_writer.close)
+    return _writer
+
+
+def _local_writer_alive(path):
+    """Whether an .open segment belongs to a process still running on this host"""
+    try:
+        host, pid, _, _ = path.stem.rsplit('-', 3)
+        pid = int(pid)
+    except ValueError:
+        return False
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def seal_stale_segments(directory, stale_after):
+    """
+    Seal .open segments left behind by writers that stopped (e.g. crashed).
+
+    A segment is sealed once untouched for ``stale_after`` seconds and its
+    writer process is gone; files of live writers on other hosts are sealed
+    on age alone, and those writers move on to a new segment.
+    """
+    cutoff = time.time() - stale_after
+    for path in Path(directory).glob(f"*{OPEN_SUFFIX}"):
+        try:
+            if path.stat().st_mtime < cutoff and not _local_writer_alive(path):
+                os.replace(path, path.with_suffix(SEALED_SUFFIX))
+        except FileNotFoundError:
+            # Sealed by its writer meanwhile
+            pass
+
+
+def replay_spool(directory=None, batch_size=1000):
+    """
+    Load sealed segments into RequestLog; returns the number of records
+    inserted (0 when another replay of the directory is running).
+    """
+    options = get_spool_settings()
+    directory = directory or options['directory']
+    if not directory or not os.path.isdir(directory):
+        return 0
+
+    with open(Path(directory) / REPLAY_LOCK, 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return 0
+        try:
+            return _replay_locked(directory, options, batch_size)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _replay_locked(directory, options, batch_size):
+    from .models import RequestLog, SpoolCheckpoint
+
+    seal_stale_segments(directory, options['stale_after'])
+
+    inserted = 0
+    for path in sorted(Path(directory).glob(f"*{SEALED_SUFFIX}")):
+        checkpoint = SpoolCheckpoint.objects.filter(segment=path.name).first()
+        offset = checkpoint.offset if checkpoint else len(SEGMENT_MAGIC)
+
+        try:
+            batch = []
+            for next_offset, record in iter_records(path, offset):
+                batch.append(RequestLog(**RequestLog.clip_fields(record)))
+                if len(batch) >= batch_size:
+                    inserted += _load_batch(path.name, batch, next_offset)
+                    batch = []
+            if batch:
+                inserted += _load_batch(path.name, batch, next_offset)
+        except (DataError, IntegrityError) as e:
+            # Set the segment aside (its checkpoint is kept) so it can't
+            # block the segments after it
+            print(f"Error replaying spool segment {path.name}: {e}")
+            os.replace(path, path.with_suffix(FAILED_SUFFIX))
+            continue
+
+        # Remove the file before the checkpoint so a crash in between can't
+        # replay the segment again
+        path.unlink()
+        SpoolCheckpoint.objects.filter(segment=path.name).delete()
+
+    return inserted
+
+
+def _load_batch(segment, batch, next_offset):
+    from .models import RequestLog, SpoolCheckpoint
+
+    with transaction.atomic():
+        RequestLog.objects.bulk_create(batch)
+        SpoolCheckpoint.objects.update_or_create(segment=segment, defaults={'offset': next_offset})
+    return len(batch)
@@ -0,0 +1,59 @@
+"""
+Startup instrumentation and pre-fork warm-up for ip_tracking.
+
+Heavy components (geo index, geo policy table, blocklist snapshot, Swagger
+schema view) are built lazily on first use and timed with ``timed()``;
+``get_startup_timings()`` reports what was loaded and how long it took.
+Set ``IP_TRACKING_STARTUP_TIMINGS = True`` to print each timing.
+
+``warm_up()`` is meant to run in a pre-forking server's master process
+(e.g. gunicorn with ``--preload``, see ``backend_security/wsgi.py``): it
+loads everything up front and freezes the garbage collector, so workers
+share the loaded data copy-on-write instead of each building their own.
+"""
+import gc
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+_timings = {}
+
+
+@contextmanager
+def timed(name):
+    """Record how long the wrapped block takes under ``name``"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _timings[name] = elapsed
+        if getattr(settings, 'IP_TRACKING_STARTUP_TIMINGS', False):
+            print(f"[ip_tracking] {name}: {elapsed * 1000:.1f} ms")
+
+
+def get_startup_timings():
+    """Return {component: seconds} for everything timed so far in this process"""
+    return dict(_timings)
+
+
+def warm_up():
+    """Load lazily-initialized components now, before workers are forked"""
+    from django.db import connections
+
+    from .blocklist import get_blocklist
+    from .geo_policy import get_geo_policy
+    from .geolocation import get_geo_index
+
+    with timed('warm up'):
+        # Decode the record table of a memory-mapped index once, in the master
+        get_geo_index().records
+        get_geo_policy()
+        get_blocklist().load()
+
+    # Database connections must not be shared with forked workers
+    connections.close_all()
+    # Move everything loaded so far out of the GC's reach, so collections in
+    # the workers don't write to (and un-share) these pages
+    gc.freeze()
@@ -1,41 +1,98 @@
+import math
+from collections import Counter
+
 from celery import shared_task
-from celery import shared_task
+from django.conf import settings
 from django.utils import timezone
 from datetime import timedelta
 from ip_tracking.models import RequestLog, SuspiciousIP
+from ip_tracking.rules import get_ruleset
+from ip_tracking.sketches import CountMinSketch, get_sketch_settings
+from ip_tracking.spool import replay_spool
+
+
+MAX_CMS_WIDTH = 1 << 20
 
-SENSITIVE_PATHS = ['/admin', '/login']
 
 @shared_task
 def flag_suspicious_ips():
     """
-    Flags IPs that:
-    1. Made more than 100 requests in the last hour
-    2. Accessed sensitive paths
+    Flags IPs whose recent requests trip a detection rule.
+
+    Rules come from ``IP_TRACKING_DETECTION_RULES`` and ``DetectionRule``;
+    each log row is matched once against the compiled rule set and an IP is
+    flagged when its hits for a rule exceed the rule's threshold.
+
+    A first pass counts hits per rule in a Count-Min Sketch sized from the
+    threshold and the number of rows, so only a few IPs below the threshold
+    become candidates. A second pass counts the candidates exactly; only
+    exact counts are flagged and recorded.
     """
+    ruleset = get_ruleset()
+    if not ruleset.rules:
+        return 0
+
     now = timezone.now()
-    one_hour_ago = now - timedelta(hours=1)
+    since = now - timedelta(seconds=ruleset.max_window)
 
     # Query recent logs
-    recent_logs = RequestLog.objects.filter(timestamp__gte=one_hour_ago)
-
-    # Count requests per IP
-    ip_counts = {}
-    for log in recent_logs:
-        ip_counts[log.ip_address] = ip_counts.get(log.ip_address, 0) + 1
-
-    # Flag IPs exceeding threshold
-    for ip, count in ip_counts.items():
-        if count > 100:
-            SuspiciousIP.objects.get_or_create(
-                ip_address=ip,
-                defaults={'reason': f'{count} requests in the past hour', 'path': log.path}
-            )
-
-    # Flag IPs accessing sensitive paths
-    sensitive_logs = recent_logs.filter(path__in=SENSITIVE_PATHS)
-    for log in sensitive_logs:
-        SuspiciousIP.objects.get_or_create(
-            ip_address=log.ip_address,
-            defaults={'reason': f'Accessed sensitive path {log.path}', 'path': log.path}
-        )
\ No newline at end of file
+    recent_logs = (RequestLog.objects
+                   .filter(timestamp__gte=since)
+                   .order_by()
+                   .values_list('ip_address', 'path', 'method', 'country',
+                                'geolocation_data__country_code', 'timestamp'))
+
+    def rule_hits():
+        for ip, path, method, country, country_code, timestamp in recent_logs.iterator(chunk_size=2000):
+            age = (now - timestamp).total_seconds()
+            for rule in ruleset.match(path, method, country, country_code):
+                if age <= rule.window:
+                    yield rule, ip
+
+    # Over-estimates average total / width per row; keep them under a quarter
+    # of the threshold
+    options = get_sketch_settings()
+    total = recent_logs.count()
+    sketches = {}
+    candidates = {}
+    for rule, ip in rule_hits():
+        if rule not in sketches:
+            width = options['cms_width']
+            if rule.threshold:
+                width = min(max(width, math.ceil(4 * total / rule.threshold)), MAX_CMS_WIDTH)
+            sketches[rule] = CountMinSketch(width, options['cms_depth'])
+            candidates[rule] = set()
+        if sketches[rule].add(ip) > rule.threshold:
+            candidates[rule].add(ip)
+    del sketches
+
+    # Count the candidates exactly
+    counts = {rule: Counter() for rule in candidates}
+    for rule, ip in rule_hits():
+        if ip in candidates[rule]:
+            counts[rule][ip] += 1
+
+    # Flag IPs exceeding rule thresholds; repeats collapse into the open incident
+    flagged = 0
+    for rule, rule_counts in counts.items():
+        for ip, count in rule_counts.items():
+            if count <= rule.threshold:
+                continue
+            description = f"Rule '{rule.name}': {count} matching requests in the past {rule.window} seconds"
+            SuspiciousIP.objects.record(ip, rule.reason, description, count=count)
+            flagged += 1
+
+    return flagged
+
+
+@shared_task
+def expire_suspicious_ips():
+    """Resolve open incidents that have not been seen for a while"""
+    idle_for = timedelta(seconds=getattr(settings, 'IP_TRACKING_INCIDENT_IDLE_TIMEOUT', 86400))
+    return SuspiciousIP.objects.open().expire(idle_for)
+
+
+@shared_task
+def replay_request_spool():
+    """Load sealed request-log spool segments into RequestLog"""
+    return replay_spool()
@@ -1,3 +1,1220 @@
-from django.test import TestCase
+import ipaddress
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import DataError, OperationalError
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from django_ratelimit.exceptions import Ratelimited
+from rest_framework.test import APIClient
+
+from .blocklist import BlocklistSnapshot, get_blocklist
+from .geo_client import CircuitBreaker, CircuitOpenError, GeoProviderClient, GeoProviderError
+from .geo_policy import GeoPolicy
+from .geolocation import GeoIndex, GeoRecord, MappedGeoIndex, get_geo_index
+from .middleware import IPLoggingMiddleware
+from .models import BlockedIP, DetectionRule, RateLimitPolicy, RequestLog, SpoolCheckpoint, SuspiciousIP
+from .rate_limits import adaptive_ratelimit
+from .rate_policy import LoadMonitor, get_rate_policy, parse_rate, reset_rate_policy
+from .rules import RuleSet, build_rule, get_ruleset, invalidate_ruleset
+from .sketches import CountMinSketch, HyperLogLog, SketchRecorder, SketchSet, SpaceSaving, get_sketch_settings
+from .startup import warm_up
+from . import analytics, sketches, spool
+from .tasks import flag_suspicious_ips
+
+# Tests must not depend on a running Redis
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+NO_SKETCHES = {'enabled': False}
+
+
+def load_blocklist(testcase):
+    """
+    Load the blocklist snapshot up front and refresh it inline: a refresh
+    thread would race the test database.
+    """
+    patcher = mock.patch.object(BlocklistSnapshot, '_start_refresh', BlocklistSnapshot._refresh)
+    patcher.start()
+    testcase.addCleanup(patcher.stop)
+    get_blocklist().load()
+
+
+class StubProviderHandler(BaseHTTPRequestHandler):
+    """Minimal ipgeolocation.io stand-in driven by attributes on the server"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, payload):
+        server = self.server
+        with server.lock:
+            server.calls.append(self.path)
+        time.sleep(server.delay)
+        body = json.dumps(payload).encode()
+        self.send_response(server.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        ip = parse_qs(urlparse(self.path).query)['ip'][0]
+        self._reply({'ip': ip, 'country_name': 'Kenya', 'country_code2': 'KE', 'city': 'Nairobi'})
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        ips = json.loads(self.rfile.read(length))['ips']
+        self._reply([{'ip': ip, 'country_name': 'Kenya'} for ip in ips])
+
+
+class GeoProviderClientTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubProviderHandler)
+        self.server.lock = threading.Lock()
+        self.server.calls = []
+        self.server.delay = 0
+        self.server.status = 200
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def make_client(self, **kwargs):
+        client = GeoProviderClient(
+            'test-key', base_url=f'http://127.0.0.1:{self.server.server_port}', **kwargs
+        )
+        self.addCleanup(client.session.close)
+        return client
+
+    def test_lookup(self):
+        client = self.make_client()
+        self.assertEqual(client.lookup('41.90.0.1')['city'], 'Nairobi')
+        self.assertIn('apiKey=test-key', self.server.calls[0])
+
+    def test_concurrent_lookups_for_same_ip_are_coalesced(self):
+        self.server.delay = 0.2
+        client = self.make_client()
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(client.lookup('41.90.0.1')))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len(self.server.calls), 1)
+
+    def test_lookup_many_uses_bulk_endpoint_in_batches(self):
+        client = self.make_client(batch_size=2)
+        results = client.lookup_many(['1.1.1.1', '2.2.2.2', '3.3.3.3', '1.1.1.1'])
+
+        self.assertEqual(set(results), {'1.1.1.1', '2.2.2.2', '3.3.3.3'})
+        self.assertEqual(len(self.server.calls), 2)
+
+    def test_read_timeout_is_enforced(self):
+        self.server.delay = 0.5
+        client = self.make_client(read_timeout=0.1)
+        with self.assertRaises(GeoProviderError):
+            client.lookup('41.90.0.1')
+
+    def test_circuit_opens_after_repeated_failures(self):
+        self.server.status = 503
+        client = self.make_client(failure_threshold=2, reset_timeout=60)
+        for _ in range(2):
+            with self.assertRaises(GeoProviderError):
+                client.lookup('41.90.0.1')
+
+        with self.assertRaises(CircuitOpenError):
+            client.lookup('41.90.0.1')
+        self.assertEqual(len(self.server.calls), 2)
+
+    def test_rate_limiting_and_auth_errors_open_the_circuit(self):
+        for status in (429, 401):
+            self.server.status = status
+            client = self.make_client(failure_threshold=1, reset_timeout=60)
+            with self.assertRaises(GeoProviderError):
+                client.lookup('41.90.0.1')
+            with self.assertRaises(CircuitOpenError):
+                client.lookup('41.90.0.1')
+
+    def test_other_client_errors_do_not_open_the_circuit(self):
+        self.server.status = 404
+        client = self.make_client(failure_threshold=1, reset_timeout=60)
+        for _ in range(2):
+            with self.assertRaises(GeoProviderError) as raised:
+                client.lookup('41.90.0.1')
+            self.assertNotIsInstance(raised.exception, CircuitOpenError)
+        self.assertEqual(len(self.server.calls), 2)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+
+    def test_half_open_allows_a_single_trial(self):
+        now = [0]
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=lambda: now[0])
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+
+        now[0] = 10
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+
+
+class RuleSetTests(SimpleTestCase):
+
+    def make_ruleset(self, *configs):
+        return RuleSet([build_rule({'reason': 'suspicious_pattern', **config}) for config in configs])
+
+    def names(self, rules):
+        return [rule.name for rule in rules]
+
+    def test_prefixes_match_through_the_trie(self):
+        ruleset = self.make_ruleset(
+            {'name': 'admin', 'prefixes': ['/admin']},
+            {'name': 'admin-auth', 'prefixes': ['/admin/auth']},
+            {'name': 'login', 'prefixes': ['/login']},
+        )
+        self.assertEqual(self.names(ruleset.match('/admin/auth/user/')), ['admin', 'admin-auth'])
+        self.assertEqual(self.names(ruleset.match('/adm')), [])
+
+    def test_combined_regex_reports_every_matching_pattern(self):
+        ruleset = self.make_ruleset(
+            {'name': 'dotfiles', 'regexes': [r'/\.(git|env)']},
+            {'name': 'php', 'regexes': [r'\.php$']},
+        )
+        self.assertEqual(self.names(ruleset.match('/.git/config.php')), ['dotfiles', 'php'])
+        self.assertEqual(self.names(ruleset.match('/index.php')), ['php'])
+        self.assertEqual(self.names(ruleset.match('/home/')), [])
+
+    def test_methods_and_countries_restrict_matches(self):
+        ruleset = self.make_ruleset(
+            {'name': 'post-login', 'prefixes': ['/login'], 'methods': ['post']},
+            {'name': 'russia', 'countries': ['RU']},
+            {'name': 'everything'},
+        )
+        self.assertEqual(self.names(ruleset.match('/login', 'GET')), ['everything'])
+        self.assertEqual(self.names(ruleset.match('/login', 'POST')), ['post-login', 'everything'])
+        # Rule countries match the ISO code as well as the stored country name
+        self.assertEqual(self.names(ruleset.match('/', 'GET', 'Russia', 'RU')), ['russia', 'everything'])
+        self.assertEqual(self.names(ruleset.match('/', 'GET', 'Kenya', 'KE')), ['everything'])
+
+    def test_invalid_rules_are_rejected(self):
+        with self.assertRaises(ImproperlyConfigured):
+            build_rule({'name': 'bad-reason', 'reason': 'nope'})
+        with self.assertRaises(ImproperlyConfigured):
+            build_rule({'name': 'bad-regex', 'reason': 'high_volume', 'regexes': ['(']})
+        with self.assertRaises(ImproperlyConfigured):
+            build_rule({'name': 'backreference', 'reason': 'high_volume', 'regexes': [r'(a)\1']})
+        with self.assertRaises(ImproperlyConfigured):
+            build_rule({'name': 'not-a-list', 'reason': 'high_volume', 'prefixes': '/admin'})
+
+    def test_inline_flags_work_in_the_combined_regex(self):
+        ruleset = self.make_ruleset(
+            {'name': 'php', 'regexes': [r'\.php$']},
+            {'name': 'wp', 'regexes': [r'(?i)/wp-admin']},
+        )
+        self.assertEqual(self.names(ruleset.match('/WP-Admin/index.php')), ['php', 'wp'])
+        self.assertEqual(self.names(ruleset.match('/WP-ADMIN/')), ['wp'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, IP_TRACKING_DETECTION_RULES=[
+    {'name': 'admin', 'reason': 'sensitive_access', 'prefixes': ['/admin']},
+])
+class DetectionRuleModelTests(TestCase):
+
+    def test_clean_rejects_invalid_fields(self):
+        rule = DetectionRule(name='bad', reason='sensitive_access', path_prefixes='/admin')
+        with self.assertRaises(ValidationError):
+            rule.clean()
+        rule.path_prefixes, rule.path_regexes = ['/admin'], [r'(a)\1']
+        with self.assertRaises(ValidationError):
+            rule.clean()
+        rule.path_regexes = [r'(?i)/wp-admin']
+        rule.clean()
+
+    def test_invalid_rows_are_skipped(self):
+        DetectionRule.objects.create(name='bad', reason='sensitive_access', path_prefixes='/admin')
+        DetectionRule.objects.create(name='wp', reason='sensitive_access', path_regexes=['/wp-'])
+        invalidate_ruleset()
+        ruleset = get_ruleset()
+        self.assertEqual([rule.name for rule in ruleset.rules], ['admin', 'wp'])
+        self.assertEqual(ruleset.match('/anything'), [])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class FlagSuspiciousIPsTests(TestCase):
+
+    def log(self, ip_address, path, count=1, **fields):
+        RequestLog.objects.bulk_create(
+            RequestLog(ip_address=ip_address, path=path, method='GET', **fields) for _ in range(count)
+        )
+
+    @override_settings(IP_TRACKING_DETECTION_RULES=[
+        {'name': 'russia', 'reason': 'suspicious_pattern', 'countries': ['RU'], 'threshold': 1},
+    ])
+    def test_country_rules_match_the_logged_country_code(self):
+        self.log('5.5.5.5', '/', count=2, country='Russia', geolocation_data={'country_code': 'RU'})
+        self.log('6.6.6.6', '/', count=2, country='Kenya', geolocation_data={'country_code': 'KE'})
+
+        self.assertEqual(flag_suspicious_ips(), 1)
+        self.assertEqual(list(SuspiciousIP.objects.values_list('ip_address', flat=True)), ['5.5.5.5'])
+
+    @override_settings(
+        IP_TRACKING_DETECTION_RULES=[
+            {'name': 'admin', 'reason': 'sensitive_access', 'prefixes': ['/admin'], 'threshold': 3},
+        ],
+        IP_TRACKING_SKETCHES={'cms_width': 16, 'cms_depth': 2, 'top_k': 5},
+    )
+    def test_every_offender_is_flagged_with_its_exact_count(self):
+        offenders = [f'10.0.0.{n}' for n in range(1, 13)]
+        for ip in offenders:
+            self.log(ip, '/admin/', count=4)
+        # Plenty of traffic below the threshold to collide with in the sketch
+        for n in range(200):
+            self.log(f'10.1.{n // 256}.{n % 256}', '/admin/', count=3)
+
+        self.assertEqual(flag_suspicious_ips(), len(offenders))
+        self.assertCountEqual(
+            SuspiciousIP.objects.values_list('ip_address', 'request_count'),
+            [(ip, 4) for ip in offenders],
+        )
+
+
+def make_geo_index(*rows):
+    """GeoIndex from (start_ip, end_ip, country_code, country, asn, isp) tuples"""
+    return GeoIndex(
+        (ipaddress.ip_address(start), ipaddress.ip_address(end), GeoRecord(*attributes))
+        for start, end, *attributes in rows
+    )
+
+
+class GeoPolicyTests(SimpleTestCase):
+
+    def setUp(self):
+        self.index = make_geo_index(
+            ('1.0.0.0', '1.0.0.255', 'RU', 'Russia', '100', 'Rostelecom'),
+            ('1.0.1.0', '1.0.1.255', 'RU', 'Russia', '200', 'Yandex'),
+            ('1.0.2.0', '1.0.2.255', 'KE', 'Kenya', 'AS300', 'Safaricom'),
+            ('2001:db8::', '2001:db8::ffff', 'RU', 'Russia', '100', 'Rostelecom'),
+        )
+
+    def test_adjacent_ranges_with_the_same_decision_are_merged(self):
+        policy = GeoPolicy({'deny_countries': ['RU']}, self.index)
+        self.assertEqual(policy.starts[4], [int(ipaddress.ip_address('1.0.0.0')), int(ipaddress.ip_address('1.0.2.0'))])
+        self.assertEqual(policy.decisions[4], [True, False])
+        self.assertTrue(policy.is_denied('1.0.1.7'))
+        self.assertFalse(policy.is_denied('1.0.2.7'))
+        self.assertTrue(policy.is_denied('2001:db8::1'))
+
+    def test_countries_match_code_or_name(self):
+        policy = GeoPolicy({'deny_countries': ['kenya']}, self.index)
+        self.assertTrue(policy.is_denied('1.0.2.1'))
+        self.assertFalse(policy.is_denied('1.0.0.1'))
+
+    def test_allowed_asn_overrides_country_rules(self):
+        policy = GeoPolicy({'deny_countries': ['RU'], 'allow_asns': ['AS200']}, self.index)
+        self.assertTrue(policy.is_denied('1.0.0.1'))
+        self.assertFalse(policy.is_denied('1.0.1.1'))
+
+    def test_allow_list_and_default_decision(self):
+        policy = GeoPolicy({'allow_countries': ['KE'], 'default': 'deny'}, self.index)
+        self.assertFalse(policy.is_denied('1.0.2.1'))
+        self.assertTrue(policy.is_denied('1.0.0.1'))
+        # Not covered by the index, or not an IP at all
+        self.assertTrue(policy.is_denied('8.8.8.8'))
+        self.assertTrue(policy.is_denied('not-an-ip'))
+
+    def test_isp_and_asn_deny_lists(self):
+        policy = GeoPolicy({'deny_isps': ['safaricom'], 'deny_asns': ['100']}, self.index)
+        self.assertTrue(policy.is_denied('1.0.2.1'))
+        self.assertTrue(policy.is_denied('1.0.0.1'))
+        self.assertFalse(policy.is_denied('1.0.1.1'))
+
+    def test_empty_policy_denies_nothing(self):
+        policy = GeoPolicy({}, self.index)
+        self.assertFalse(policy.is_active)
+        self.assertFalse(policy.is_denied('1.0.0.1'))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BlocklistSnapshotTests(TestCase):
+
+    def make_snapshot(self, **kwargs):
+        snapshot = BlocklistSnapshot(**kwargs)
+        # Refreshes run inline when called explicitly, never from a thread
+        patcher = mock.patch.object(snapshot, '_start_refresh')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return snapshot
+
+    def test_database_answers_until_the_first_load(self):
+        BlockedIP.objects.create(ip_address='10.0.0.1')
+        snapshot = self.make_snapshot()
+        with self.assertNumQueries(1):
+            self.assertTrue(snapshot.is_blocked('10.0.0.1'))
+
+        snapshot.load()
+        with self.assertNumQueries(0):
+            self.assertTrue(snapshot.is_blocked('10.0.0.1'))
+            self.assertFalse(snapshot.is_blocked('10.0.0.2'))
+
+    def test_refresh_reloads_after_a_version_change(self):
+        snapshot = self.make_snapshot()
+        snapshot.load()
+        BlockedIP.objects.create(ip_address='10.0.0.1')
+        snapshot._refresh()
+        self.assertTrue(snapshot.is_blocked('10.0.0.1'))
+
+    def test_every_delete_path_invalidates(self):
+        snapshot = self.make_snapshot()
+        BlockedIP.objects.bulk_create([BlockedIP(ip_address='10.0.0.1'), BlockedIP(ip_address='10.0.0.2')])
+        snapshot.load()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            BlockedIP.objects.get(ip_address='10.0.0.1').delete()
+        snapshot._refresh()
+        self.assertEqual(snapshot.ips, {'10.0.0.2'})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            BlockedIP.objects.filter(ip_address='10.0.0.2').delete()
+        snapshot._refresh()
+        self.assertEqual(snapshot.ips, frozenset())
+
+    def test_old_snapshots_are_reloaded_without_a_version_change(self):
+        snapshot = self.make_snapshot(max_age=3600)
+        snapshot.load()
+        # bulk_create sends no signals, so the version stays the same
+        BlockedIP.objects.bulk_create([BlockedIP(ip_address='10.0.0.1')])
+        snapshot._refresh()
+        self.assertFalse(snapshot.is_blocked('10.0.0.1'))
+
+        snapshot.max_age = 0
+        snapshot._refresh()
+        self.assertTrue(snapshot.is_blocked('10.0.0.1'))
+
+    def test_failed_refresh_keeps_the_previous_snapshot(self):
+        BlockedIP.objects.create(ip_address='10.0.0.1')
+        snapshot = self.make_snapshot(max_age=0)
+        snapshot.load()
+        with mock.patch.object(snapshot, 'load', side_effect=OperationalError('database is locked')), \
+                mock.patch('builtins.print') as report:
+            snapshot._refresh()
+        report.assert_called_once()
+        self.assertTrue(snapshot.is_blocked('10.0.0.1'))
+        self.assertFalse(snapshot._loading)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, IP_TRACKING_SKETCHES=NO_SKETCHES)
+class BlocklistAPITests(TestCase):
+
+    def setUp(self):
+        load_blocklist(self)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username='admin', is_staff=True))
+
+    def test_bulk_create_skips_existing_and_repeated_ips(self):
+        BlockedIP.objects.create(ip_address='10.0.0.1')
+        response = self.client.post('/api/blocked-ips/', [
+            {'ip_address': '10.0.0.1'},
+            {'ip_address': '10.0.0.2', 'reason': 'scanner'},
+            {'ip_address': '10.0.0.2', 'reason': 'scanner'},
+            {'ip_address': '10.0.0.3'},
+        ], format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data, {'created': 2, 'skipped': 2})
+        self.assertEqual(BlockedIP.objects.count(), 3)
+
+    def test_single_create_rejects_duplicates(self):
+        BlockedIP.objects.create(ip_address='10.0.0.1')
+        response = self.client.post('/api/blocked-ips/', {'ip_address': '10.0.0.1'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_delete(self):
+        BlockedIP.objects.bulk_create(BlockedIP(ip_address=f'10.0.0.{i}') for i in range(1, 4))
+        response = self.client.post(
+            '/api/blocked-ips/bulk-delete/', {'ip_addresses': ['10.0.0.1', '10.0.0.2', '10.0.0.9']}, format='json'
+        )
+        self.assertEqual(response.data, {'deleted': 2})
+        self.assertEqual(list(BlockedIP.objects.values_list('ip_address', flat=True)), ['10.0.0.3'])
+
+    def test_bulk_resolve_only_touches_open_incidents(self):
+        SuspiciousIP.objects.record('10.0.0.1', 'high_volume', 'x')
+        SuspiciousIP.objects.record('10.0.0.1', 'sensitive_access', 'x')
+        SuspiciousIP.objects.record('10.0.0.2', 'high_volume', 'x')
+        response = self.client.post(
+            '/api/suspicious-ips/bulk-resolve/', {'ip_addresses': ['10.0.0.1']}, format='json'
+        )
+        self.assertEqual(response.data, {'resolved': 2})
+        self.assertEqual(list(SuspiciousIP.objects.open().values_list('ip_address', flat=True)), ['10.0.0.2'])
+
+    def test_requires_admin(self):
+        self.client.force_authenticate(User.objects.create(username='user'))
+        self.assertEqual(self.client.get('/api/blocked-ips/').status_code, 403)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SuspiciousIPRecordTests(TestCase):
+
+    def test_repeats_collapse_into_the_open_incident(self):
+        self.assertTrue(SuspiciousIP.objects.record('10.0.0.1', 'high_volume', 'first', count=120))
+        self.assertFalse(SuspiciousIP.objects.record('10.0.0.1', 'high_volume', 'second', count=150))
+
+        incident = SuspiciousIP.objects.get()
+        self.assertEqual(incident.description, 'second')
+        # The latest window count replaces the stored one
+        self.assertEqual(incident.request_count, 150)
+
+    def test_a_resolved_incident_is_not_reopened(self):
+        SuspiciousIP.objects.record('10.0.0.1', 'high_volume', 'first')
+        SuspiciousIP.objects.resolve()
+        self.assertTrue(SuspiciousIP.objects.record('10.0.0.1', 'high_volume', 'again'))
+        self.assertEqual(SuspiciousIP.objects.count(), 2)
+        self.assertEqual(SuspiciousIP.objects.open().count(), 1)
+
+    def test_reasons_are_separate_incidents(self):
+        SuspiciousIP.objects.record('10.0.0.1', 'high_volume', 'x')
+        SuspiciousIP.objects.record('10.0.0.1', 'sensitive_access', 'x')
+        self.assertEqual(SuspiciousIP.objects.open().count(), 2)
+
+    @override_settings(IP_TRACKING_DETECTION_RULES=[
+        {'name': 'admin', 'reason': 'sensitive_access', 'prefixes': ['/admin'], 'threshold': 0},
+    ])
+    def test_periodic_runs_over_the_same_window_do_not_double_count(self):
+        RequestLog.objects.create(ip_address='10.0.0.1', path='/admin/', method='GET')
+        flag_suspicious_ips()
+        flag_suspicious_ips()
+        self.assertEqual(SuspiciousIP.objects.get().request_count, 1)
+
+    def test_expire_resolves_idle_incidents(self):
+        SuspiciousIP.objects.record('10.0.0.1', 'high_volume', 'x')
+        SuspiciousIP.objects.update(last_seen=timezone.now() - timedelta(days=2))
+        SuspiciousIP.objects.record('10.0.0.2', 'high_volume', 'x')
+
+        self.assertEqual(SuspiciousIP.objects.open().expire(timedelta(days=1)), 1)
+        self.assertEqual(list(SuspiciousIP.objects.open().values_list('ip_address', flat=True)), ['10.0.0.2'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, IP_TRACKING_SKETCHES=NO_SKETCHES)
+class LargeTableAdminTests(TestCase):
+
+    def setUp(self):
+        load_blocklist(self)
+        self.client.force_login(User.objects.create(username='admin', is_staff=True, is_superuser=True))
+
+    def test_changelist_pages_by_primary_key(self):
+        RequestLog.objects.bulk_create(
+            RequestLog(ip_address='10.0.0.1', path=f'/page/{i}', method='GET') for i in range(150)
+        )
+        first = self.client.get('/admin/ip_tracking/requestlog/')
+        results = first.context['cl'].result_list
+        self.assertEqual(len(results), 100)
+        next_cursor = first.context['cl'].next_cursor
+        self.assertEqual(next_cursor, results[-1].pk)
+
+        second = self.client.get(f'/admin/ip_tracking/requestlog/?after={next_cursor}')
+        self.assertEqual(len(second.context['cl'].result_list), 50)
+        self.assertIsNone(second.context['cl'].next_cursor)
+
+    def test_search_uses_exact_ip_or_path_prefix(self):
+        RequestLog.objects.create(ip_address='10.0.0.1', path='/wp-login.php', method='GET')
+        RequestLog.objects.create(ip_address='10.0.0.2', path='/api/', method='GET')
+
+        by_ip = self.client.get('/admin/ip_tracking/requestlog/?q=10.0.0.2')
+        self.assertEqual([log.path for log in by_ip.context['cl'].result_list], ['/api/'])
+        by_path = self.client.get('/admin/ip_tracking/requestlog/?q=/wp-')
+        self.assertEqual([log.ip_address for log in by_path.context['cl'].result_list], ['10.0.0.1'])
+
+    def test_block_action_reports_only_new_blocks(self):
+        BlockedIP.objects.create(ip_address='10.0.0.1')
+        SuspiciousIP.objects.record('10.0.0.1', 'high_volume', 'x')
+        SuspiciousIP.objects.record('10.0.0.2', 'high_volume', 'x')
+
+        response = self.client.post('/admin/ip_tracking/suspiciousip/', {
+            'action': 'block_selected_ips',
+            '_selected_action': list(SuspiciousIP.objects.values_list('pk', flat=True)),
+        }, follow=True)
+
+        self.assertEqual(
+            [str(message) for message in response.context['messages']],
+            ['Blocked 1 IP addresses (1 were already blocked).'],
+        )
+        self.assertEqual(BlockedIP.objects.count(), 2)
+
+    def test_block_from_inserts_distinct_ips_in_one_query(self):
+        BlockedIP.objects.create(ip_address='10.0.0.1')
+        RequestLog.objects.bulk_create(
+            RequestLog(ip_address=ip, path='/', method='GET')
+            for ip in ['10.0.0.1', '10.0.0.2', '10.0.0.2', '10.0.0.3']
+        )
+
+        with self.assertNumQueries(1):
+            created = BlockedIP.objects.block_from(RequestLog.objects.all(), 'From logs')
+        self.assertEqual(created, 2)
+        self.assertCountEqual(
+            BlockedIP.objects.filter(reason='From logs').values_list('ip_address', flat=True),
+            ['10.0.0.2', '10.0.0.3'],
+        )
+        self.assertFalse(BlockedIP.objects.filter(created_at__isnull=True).exists())
+
+
+def spool_record(path='/', **fields):
+    return {
+        'ip_address': '10.0.0.1',
+        'timestamp': datetime(2026, 10, 19, 12, 0, tzinfo=dt_timezone.utc),
+        'path': path,
+        'method': 'GET',
+        'country': 'Kenya',
+        'geolocation_data': {'country_code': 'KE'},
+        **fields,
+    }
+
+
+class SpoolTestMixin:
+
+    def setUp(self):
+        super().setUp()
+        temporary = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary.cleanup)
+        self.directory = Path(temporary.name)
+
+    def make_writer(self, **kwargs):
+        writer = spool.SpoolWriter(self.directory, **kwargs)
+        self.addCleanup(writer.close)
+        return writer
+
+    def segments(self, suffix):
+        return sorted(self.directory.glob(f'*{suffix}'))
+
+
+class SpoolFormatTests(SpoolTestMixin, SimpleTestCase):
+
+    def test_encode_decode_round_trip(self):
+        record = spool_record('/api/', ip_address='2001:db8::1', latitude=None, city='Nairobi')
+        frame = spool.encode_record(record)
+        decoded = spool.decode_record(frame[spool.FRAME.size:])
+        self.assertEqual(decoded['ip_address'], '2001:db8::1')
+        self.assertEqual(decoded['timestamp'], record['timestamp'])
+        self.assertEqual(decoded['path'], '/api/')
+        self.assertEqual(decoded['city'], 'Nairobi')
+        self.assertIsNone(decoded['latitude'])
+        self.assertEqual(decoded['geolocation_data'], {'country_code': 'KE'})
+
+    def test_iteration_stops_at_a_torn_tail(self):
+        writer = self.make_writer()
+        for index in range(3):
+            writer.append(spool_record(f'/{index}'))
+        path = self.segments(spool.OPEN_SUFFIX)[0]
+        os.truncate(path, path.stat().st_size - 3)
+
+        self.assertEqual([record['path'] for _, record in spool.iter_records(path)], ['/0', '/1'])
+
+    def test_stale_segment_of_a_live_writer_is_not_sealed(self):
+        writer = self.make_writer()
+        writer.append(spool_record('/first'))
+        path = self.segments(spool.OPEN_SUFFIX)[0]
+        os.utime(path, (0, 0))
+
+        spool.seal_stale_segments(self.directory, stale_after=60)
+        self.assertTrue(path.exists())
+        writer.append(spool_record('/second'))
+        writer.close()
+
+        sealed = self.segments(spool.SEALED_SUFFIX)
+        self.assertEqual(len(sealed), 1)
+        self.assertEqual([record['path'] for _, record in spool.iter_records(sealed[0])], ['/first', '/second'])
+
+    def test_stale_segment_of_a_dead_writer_is_sealed(self):
+        path = self.directory / f'{socket.gethostname()}-999999999-0-000001{spool.OPEN_SUFFIX}'
+        path.write_bytes(spool.SEGMENT_MAGIC)
+        os.utime(path, (0, 0))
+
+        spool.seal_stale_segments(self.directory, stale_after=60)
+        self.assertEqual(self.segments(spool.OPEN_SUFFIX), [])
+        self.assertEqual(len(self.segments(spool.SEALED_SUFFIX)), 1)
+
+    def test_writer_moves_on_when_its_segment_was_sealed_elsewhere(self):
+        writer = self.make_writer()
+        writer.append(spool_record('/first'))
+        path = self.segments(spool.OPEN_SUFFIX)[0]
+        os.replace(path, path.with_suffix(spool.SEALED_SUFFIX))
+        writer._verified_at -= spool.VERIFY_INTERVAL
+
+        writer.append(spool_record('/second'))
+        writer.close()
+
+        paths = [
+            record['path']
+            for segment in self.segments(spool.SEALED_SUFFIX)
+            for _, record in spool.iter_records(segment)
+        ]
+        self.assertEqual(sorted(paths), ['/first', '/second'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SpoolReplayTests(SpoolTestMixin, TestCase):
+
+    def write_segment(self, *records):
+        # One writer, like in a process: each close() seals a new segment
+        if not hasattr(self, 'writer'):
+            self.writer = self.make_writer()
+        for record in records:
+            self.writer.append(record)
+        self.writer.close()
+        return self.segments(spool.SEALED_SUFFIX)[-1]
+
+    def test_replay_resumes_from_the_checkpoint(self):
+        path = self.write_segment(*(spool_record(f'/{index}') for index in range(5)))
+        offsets = [offset for offset, _ in spool.iter_records(path)]
+        SpoolCheckpoint.objects.create(segment=path.name, offset=offsets[1])
+
+        self.assertEqual(spool.replay_spool(self.directory, batch_size=2), 3)
+        self.assertEqual(sorted(RequestLog.objects.values_list('path', flat=True)), ['/2', '/3', '/4'])
+        self.assertFalse(path.exists())
+        self.assertFalse(SpoolCheckpoint.objects.exists())
+
+    def test_replay_clips_fields_to_column_lengths(self):
+        self.write_segment(spool_record('/' + 'a' * 400))
+        spool.replay_spool(self.directory)
+        self.assertEqual(len(RequestLog.objects.get().path), 255)
+
+    def test_rejected_segment_is_set_aside(self):
+        first = self.write_segment(spool_record('/first'))
+        second = self.write_segment(spool_record('/second'))
+        self.assertNotEqual(first, second)
+        with mock.patch.object(spool, '_load_batch', side_effect=[DataError('bad row'), 1]):
+            spool.replay_spool(self.directory)
+
+        self.assertTrue(first.with_suffix(spool.FAILED_SUFFIX).exists())
+        self.assertFalse(second.exists())
+
+    def test_idle_writer_segment_is_sealed_and_replayed(self):
+        writer = self.make_writer(segment_age=0.1, fsync_interval=0.05)
+        writer.append(spool_record('/outage'))
+
+        deadline = time.monotonic() + 5
+        while not self.segments(spool.SEALED_SUFFIX) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        # The writer is alive, so replay doesn't seal its segment itself
+        spool.seal_stale_segments(self.directory, 0)
+        self.assertEqual(spool.replay_spool(self.directory), 1)
+        self.assertEqual(RequestLog.objects.get().path, '/outage')
+
+        # The writer carries on in a new segment
+        writer.append(spool_record('/after'))
+        self.assertEqual(len(self.segments(spool.OPEN_SUFFIX)), 1)
+
+    def test_idle_writer_fsyncs_pending_records(self):
+        writer = self.make_writer(fsync_every=100, fsync_interval=0.05)
+        with mock.patch.object(spool.os, 'fsync', wraps=os.fsync) as fsync:
+            writer.append(spool_record('/'))
+            deadline = time.monotonic() + 5
+            while writer._pending and time.monotonic() < deadline:
+                time.sleep(0.05)
+        self.assertEqual(writer._pending, 0)
+        self.assertTrue(fsync.called)
+
+    def test_only_one_replay_runs_per_directory(self):
+        self.write_segment(spool_record('/'))
+        with open(self.directory / spool.REPLAY_LOCK, 'a') as lock:
+            spool.fcntl.flock(lock, spool.fcntl.LOCK_EX)
+            self.assertEqual(spool.replay_spool(self.directory), 0)
+        self.assertEqual(spool.replay_spool(self.directory), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, IP_TRACKING_SKETCHES=NO_SKETCHES, IP_TRACKING_LOG_SINK='db')
+class MiddlewareSpoolTests(SpoolTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        load_blocklist(self)
+        self.writer = self.make_writer()
+        patcher = mock.patch('ip_tracking.middleware.get_spool_writer', return_value=self.writer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.middleware = IPLoggingMiddleware(lambda request: HttpResponse('ok'))
+
+    def call(self, path='/'):
+        return self.middleware(RequestFactory().get(path, REMOTE_ADDR='10.0.0.1'))
+
+    def spooled(self):
+        self.writer.close()
+        return [record for segment in self.segments(spool.SEALED_SUFFIX) for _, record in spool.iter_records(segment)]
+
+    def test_long_paths_are_clipped_before_insert(self):
+        self.call('/' + 'a' * 400)
+        self.assertEqual(len(RequestLog.objects.get().path), 255)
+
+    def test_connectivity_errors_are_spooled(self):
+        with mock.patch.object(RequestLog.objects, 'create', side_effect=OperationalError('down')):
+            self.call('/down')
+        self.assertEqual([record['path'] for record in self.spooled()], ['/down'])
+
+    def test_rejected_rows_are_not_spooled(self):
+        with mock.patch.object(RequestLog.objects, 'create', side_effect=DataError('bad row')):
+            self.call('/bad')
+        self.assertEqual(self.spooled(), [])
+
+
+class MappedGeoIndexTests(SpoolTestMixin, SimpleTestCase):
+
+    def test_lookups_match_the_in_memory_index(self):
+        index = make_geo_index(
+            ('1.0.0.0', '1.0.0.255', 'RU', 'Russia', '100', 'Rostelecom'),
+            ('1.0.2.0', '1.0.2.255', 'KE', 'Kenya', '300', 'Safaricom'),
+            ('255.255.255.0', '255.255.255.255', 'US', 'United States', '', ''),
+            ('2001:db8::', '2001:db8::ffff', 'RU', 'Russia', '100', 'Rostelecom'),
+        )
+        path = self.directory / 'geo.bin'
+        index.save(path)
+        mapped = MappedGeoIndex(path)
+        self.addCleanup(mapped.buffer.close)
+
+        self.assertEqual(len(mapped), len(index))
+        for version in (4, 6):
+            self.assertEqual(
+                [(start, end, record.as_dict()) for start, end, record in mapped.ranges(version)],
+                [(start, end, record.as_dict()) for start, end, record in index.ranges(version)],
+            )
+        for ip in ('0.0.0.1', '1.0.0.0', '1.0.0.255', '1.0.1.0', '1.0.2.9', '255.255.255.255',
+                   '2001:db8::1', '2001:db9::', 'bogus'):
+            expected = index.lookup(ip)
+            found = mapped.lookup(ip)
+            self.assertEqual(found and found.as_dict(), expected and expected.as_dict(), ip)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class WarmUpTests(SpoolTestMixin, TestCase):
+
+    def test_warm_up_decodes_the_mapped_record_table(self):
+        path = self.directory / 'geo.bin'
+        make_geo_index(('1.0.0.0', '1.0.0.255', 'KE', 'Kenya', '300', 'Safaricom')).save(path)
+
+        with override_settings(IP_TRACKING_GEO_INDEX_PATH=str(path)), \
+                mock.patch('ip_tracking.startup.gc'), \
+                mock.patch('django.db.connections.close_all'):
+            warm_up()
+            index = get_geo_index()
+
+        self.assertIsInstance(index, MappedGeoIndex)
+        self.assertIsNotNone(index._records)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RequestLogAnalyticsTests(SpoolTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.day = datetime(2026, 10, 19, tzinfo=dt_timezone.utc)
+        rows = [
+            ('10.0.0.1', '/admin/', 'POST', 'Kenya', 1),
+            ('10.0.0.1', '/admin/', 'POST', 'Kenya', 1),
+            ('10.0.0.1', '/api/', 'GET', 'Kenya', 2),
+            ('10.0.0.2', '/admin/login/', 'GET', 'Russia', 2),
+            ('10.0.0.2', '/api/', 'GET', 'Russia', 13),
+            ('10.0.0.3', '/', 'GET', None, 13),
+        ]
+        codes = {'Kenya': 'KE', 'Russia': 'RU'}
+        RequestLog.objects.bulk_create(
+            RequestLog(ip_address=ip, path=path, method=method, country=country,
+                       geolocation_data={'country_code': codes[country]} if country else None,
+                       timestamp=self.day + timedelta(hours=hour))
+            for ip, path, method, country, hour in rows
+        )
+        # Outside the exported day
+        RequestLog.objects.create(ip_address='10.0.0.9', path='/', method='GET',
+                                  timestamp=self.day - timedelta(hours=1))
+        self.assertEqual(analytics.export_partition(self.directory, self.day.date()), 6)
+        self.partitions = analytics.load_partitions(self.directory)
+
+    def test_top_k(self):
+        self.assertEqual(
+            analytics.top_k(self.partitions, 'ip', k=2),
+            [('10.0.0.1', None, 3), ('10.0.0.2', None, 2)],
+        )
+        self.assertEqual(
+            analytics.top_k(self.partitions, 'ip', k=5, path_prefix='/admin', method='post'),
+            [('10.0.0.1', None, 2)],
+        )
+        self.assertEqual(
+            analytics.top_k(self.partitions, 'ip', k=1, by='path'),
+            [('10.0.0.1', '/admin/', 2)],
+        )
+        self.assertCountEqual(
+            analytics.top_k(self.partitions, 'country', k=5, since=self.day + timedelta(hours=2)),
+            [('Russia', None, 2), ('Kenya', None, 1), ('', None, 1)],
+        )
+
+    def test_histogram(self):
+        self.assertEqual(analytics.histogram(self.partitions, 'hour', country='russia'), [
+            (self.day + timedelta(hours=2), 1),
+            (self.day + timedelta(hours=13), 1),
+        ])
+        self.assertEqual(analytics.histogram(self.partitions, 'day'), [(self.day, 6)])
+
+    def test_country_filter_accepts_names_and_codes(self):
+        for country in ('Russia', 'ru'):
+            self.assertEqual(
+                analytics.top_k(self.partitions, 'ip', country=country), [('10.0.0.2', None, 2)]
+            )
+        self.assertCountEqual(
+            analytics.top_k(self.partitions, 'country_code', k=5),
+            [('KE', None, 3), ('RU', None, 2), ('', None, 1)],
+        )
+
+        # Exports made before the country_code column still filter by name
+        del self.partitions[0].meta['columns']['country_code']
+        self.assertEqual(analytics.top_k(self.partitions, 'ip', country='RU'), [])
+        self.assertEqual(analytics.top_k(self.partitions, 'ip', country='russia'), [('10.0.0.2', None, 2)])
+
+    def test_re_export_replaces_the_partition(self):
+        RequestLog.objects.create(ip_address='10.0.0.4', path='/', method='GET', timestamp=self.day)
+        self.assertEqual(analytics.export_partition(self.directory, self.day.date()), 7)
+        self.assertEqual([path.name for path in self.directory.iterdir()], ['2026-10-19'])
+        self.assertEqual(analytics.load_partitions(self.directory)[0].rows, 7)
+
+    def test_previous_export_is_read_while_a_swap_is_unfinished(self):
+        # State after renaming the old export aside, before the new one lands
+        os.replace(self.directory / '2026-10-19', self.directory / '.2026-10-19.old')
+        partitions = analytics.load_partitions(self.directory)
+        self.assertEqual([partition.rows for partition in partitions], [6])
+
+        analytics.export_partition(self.directory, self.day.date())
+        self.assertEqual([path.name for path in self.directory.iterdir()], ['2026-10-19'])
+
+
+class SketchTests(SimpleTestCase):
+
+    def test_count_min_sketch_merges_and_round_trips(self):
+        first, second = CountMinSketch(64, 3), CountMinSketch(64, 3)
+        for _ in range(5):
+            first.add('10.0.0.1')
+        second.add('10.0.0.1', 3)
+        first.merge(CountMinSketch.from_bytes(second.to_bytes()))
+        self.assertEqual(first.estimate('10.0.0.1'), 8)
+        with self.assertRaises(ValueError):
+            first.merge(CountMinSketch(32, 3))
+
+    def test_space_saving_keeps_heavy_hitters_across_merges(self):
+        first, second = SpaceSaving(2), SpaceSaving(2)
+        for ip, count in [('a', 10), ('b', 1), ('c', 1)]:
+            first.add(ip, count)
+        second.add('a', 5)
+        second.add('d', 7)
+        first.merge(SpaceSaving.from_bytes(second.to_bytes()))
+        top = first.top()
+        self.assertEqual([key for key, _, _ in top], ['a', 'd'])
+        # count - error bounds the true count from below
+        self.assertEqual(top[0][1] - top[0][2], 15)
+
+    def test_space_saving_evicts_the_smallest_counter(self):
+        summary = SpaceSaving(3)
+        for key, count in [('a', 5), ('b', 2), ('c', 4)]:
+            summary.add(key, count)
+        # b's and a's heap entries go stale; c becomes the smallest
+        summary.add('b', 4)
+        summary.add('a')
+        summary.add('d')
+        self.assertEqual(sorted(summary.counts), ['a', 'b', 'd'])
+        self.assertEqual((summary.counts['d'], summary.errors['d']), (5, 4))
+
+    def test_space_saving_guarantees_under_a_rotating_flood(self):
+        summary = SpaceSaving(50)
+        exact = {}
+        for n in range(20000):
+            key = f'10.0.0.{n % 7}' if n % 2 else f'10.{n // 256 % 256}.{n % 256}.1'
+            exact[key] = exact.get(key, 0) + 1
+            summary.add(key)
+
+        self.assertEqual(len(summary.counts), 50)
+        self.assertEqual(sum(summary.counts.values()), 20000)
+        for key, count, error in summary.top():
+            self.assertGreaterEqual(count, exact[key])
+            self.assertLessEqual(count - error, exact[key])
+        # Every key above total / capacity is kept
+        heavy = {key for key, count in exact.items() if count > 20000 / 50}
+        self.assertEqual(heavy, {f'10.0.0.{n}' for n in range(7)})
+        self.assertLessEqual(heavy, set(summary.counts))
+
+    def test_hyperloglog_merge_counts_the_union(self):
+        first, second = HyperLogLog(10), HyperLogLog(10)
+        for n in range(300):
+            first.add(f'10.0.{n // 256}.{n % 256}')
+            second.add(f'10.0.{(n + 150) // 256}.{(n + 150) % 256}')
+        first.merge(HyperLogLog.from_bytes(second.to_bytes()))
+        self.assertAlmostEqual(first.count(), 450, delta=450 * 0.1)
+
+    def test_sketch_set_round_trips(self):
+        options = get_sketch_settings()
+        sketch_set = SketchSet(options)
+        sketch_set.record('10.0.0.1', '/admin/login/', 'Kenya')
+        sketch_set.record('10.0.0.1', '/api/', 'Kenya')
+        sketch_set.record('10.0.0.2', '/api/', None)
+
+        copy = SketchSet.from_bytes(sketch_set.to_bytes(), options)
+        self.assertEqual(copy.to_bytes(), sketch_set.to_bytes())
+        self.assertEqual(copy.requests.estimate('10.0.0.1'), 2)
+        self.assertEqual(copy.distinct_ips.count(), 2)
+
+
+class FakeRedis:
+    """Records pipelined HSET/EXPIRE calls and answers HVALS from them"""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.hashes = {}
+        self.calls = 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def hset(self, key, field, value):
+        self.commands.append(('hset', key, field, value))
+
+    def expire(self, key, seconds):
+        self.commands.append(('expire', key, seconds))
+
+    def hvals(self, key):
+        self.commands.append(('hvals', key))
+
+    def execute(self):
+        self.client.calls += 1
+        if self.client.fail:
+            raise ConnectionError('Redis is down')
+        results = []
+        for command, key, *args in self.commands:
+            if command == 'hset':
+                self.client.hashes.setdefault(key, {})[args[0]] = args[1]
+            results.append(list(self.client.hashes.get(key, {}).values()) if command == 'hvals' else True)
+        return results
+
+
+class SketchRecorderTests(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch.object(sketches, 'get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.options = {**get_sketch_settings(), 'flush_interval': 3600}
+
+    def make_recorder(self):
+        recorder = SketchRecorder(self.options)
+        self.addCleanup(recorder._stop.set)
+        return recorder
+
+    def test_requests_do_not_wait_for_redis(self):
+        recorder = self.make_recorder()
+        recorder.record('10.0.0.1', '/api/', 'Kenya')
+        self.assertEqual(self.redis.calls, 0)
+
+        recorder.flush()
+        self.assertEqual(self.redis.calls, 1)
+        self.assertEqual(sketches.load_sketches(300, self.options).requests.estimate('10.0.0.1'), 1)
+
+    def test_failed_flush_keeps_finished_buckets_for_the_next_one(self):
+        recorder = self.make_recorder()
+        with mock.patch.object(sketches.time, 'time', return_value=1000.0):
+            recorder.record('10.0.0.1', '/api/')
+        recorder.record('10.0.0.1', '/api/')
+
+        self.redis.fail = True
+        recorder.flush()
+        self.assertEqual(len(recorder._finished), 1)
+
+        self.redis.fail = False
+        recorder.flush()
+        self.assertEqual(recorder._finished, [])
+        self.assertEqual(len(self.redis.hashes), 2)
+
+    def test_workers_are_merged_on_read(self):
+        for pid in (101, 102):
+            recorder = self.make_recorder()
+            with mock.patch.object(sketches.os, 'getpid', return_value=pid):
+                recorder.record('10.0.0.1', '/api/')
+                recorder.flush()
+
+        merged = sketches.load_sketches(300, self.options)
+        self.assertEqual(merged.requests.estimate('10.0.0.1'), 2)
+        self.assertEqual(merged.distinct_ips.count(), 1)
+
+
+class ParseRateTests(SimpleTestCase):
+
+    def test_rates(self):
+        self.assertEqual(parse_rate('10/m'), (10, 60))
+        self.assertEqual(parse_rate('100/5m'), (100, 300))
+        self.assertEqual(parse_rate(' 3/d '), (3, 86400))
+        for rate in ('', None, '10', '10/w', 'x/m'):
+            with self.assertRaises(ImproperlyConfigured):
+                parse_rate(rate)
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    RATELIMITS={'default': '5/m', 'authenticated': '10/m', 'groups': {
+        'login': '20/m',
+        'api': {'anonymous': '30/m', 'authenticated': '60/m'},
+    }},
+    IP_TRACKING_RATE_POLICY={'high_water': 0.8, 'min_load_factor': 0.25},
+)
+class RatePolicyTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        reset_rate_policy()
+        self.addCleanup(reset_rate_policy)
+        self.policy = get_rate_policy()
+
+    def set_pressure(self, pressure):
+        patcher = mock.patch.object(LoadMonitor, 'pressure', return_value=pressure)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_base_rate_resolution_order(self):
+        self.assertEqual(self.policy.base_rate('login', False, rate='5/m'), (20, 60))
+        self.assertEqual(self.policy.base_rate('api', True), (60, 60))
+        self.assertEqual(self.policy.base_rate('other', False, rate='7/h'), (7, 3600))
+        self.assertEqual(self.policy.base_rate('other', True, rate='7/h', authenticated_rate='70/h'), (70, 3600))
+        self.assertEqual(self.policy.base_rate('other', False), (5, 60))
+        self.assertEqual(self.policy.base_rate('other', True), (10, 60))
+
+        RateLimitPolicy.objects.create(group='login', rate='2/m')
+        self.assertEqual(self.policy.base_rate('login', False, rate='5/m'), (2, 60))
+        self.assertEqual(self.policy.base_rate('login', True), (2, 60))
+
+    def test_reputation_scaling(self):
+        SuspiciousIP.objects.record('10.0.0.1', 'high_volume', 'x')
+        staff = User.objects.create_user('staff', is_staff=True)
+        member = User.objects.create_user('member')
+
+        self.assertEqual(self.policy.scale(10, '10.0.0.1'), 2)
+        self.assertEqual(self.policy.scale(10, '10.0.0.2', staff), 50)
+        self.assertEqual(self.policy.scale(10, '10.0.0.2', member), 10)
+        # Never scaled down to nothing
+        self.assertEqual(self.policy.scale(1, '10.0.0.1'), 1)
+
+    def test_load_scaling(self):
+        staff = User.objects.create_user('staff', is_staff=True)
+        self.set_pressure(0.5)
+        self.assertEqual(self.policy.scale(20, '10.0.0.2'), 20)
+
+        self.set_pressure(1.6)
+        self.assertEqual(self.policy.scale(20, '10.0.0.2'), 10)
+        self.assertEqual(self.policy.scale(20, '10.0.0.2', staff), 100)
+
+        self.set_pressure(100)
+        self.assertEqual(self.policy.scale(20, '10.0.0.2'), 5)
+
+    def test_load_monitor_pressure(self):
+        load = LoadMonitor(max_concurrency=4, target_latency=1.0, smoothing=0.5)
+        load.started()
+        load.started()
+        self.assertEqual(load.pressure(), 0.5)
+        load.finished(4.0)
+        self.assertEqual(load.pressure(), 2.0)
+
+    def test_only_suspicious_clients_are_shed_under_overload(self):
+        SuspiciousIP.objects.record('10.0.0.1', 'high_volume', 'x')
+        self.set_pressure(0.9)
+        self.assertFalse(self.policy.should_shed('10.0.0.1'))
+
+        self.set_pressure(1.2)
+        self.assertTrue(self.policy.should_shed('10.0.0.1'))
+        self.assertFalse(self.policy.should_shed('10.0.0.2'))
+
+    def test_adaptive_ratelimit_applies_the_scaled_limit(self):
+        view = adaptive_ratelimit('login', key='ip')(lambda request: HttpResponse('ok'))
+        factory = RequestFactory()
+
+        def call(ip):
+            return view(factory.get('/', REMOTE_ADDR=ip))
+
+        for _ in range(20):
+            call('10.0.0.2')
+        with self.assertRaises(Ratelimited):
+            call('10.0.0.2')
+
+        # 20/m scaled by the suspicious factor
+        SuspiciousIP.objects.record('10.0.0.1', 'high_volume', 'x')
+        for _ in range(4):
+            call('10.0.0.1')
+        with self.assertRaises(Ratelimited):
+            call('10.0.0.1')
+
+    def test_reputation_is_only_looked_up_near_the_lowest_limit(self):
+        view = adaptive_ratelimit('other', rate='100/m')(lambda request: HttpResponse('ok'))
+        # 100/m can't scale below 100 * 0.2 (suspicious) * 0.25 (min load) = 5
+        self.assertEqual(self.policy.min_limit(100), 5)
+
+        with mock.patch.object(self.policy, 'reputation', wraps=self.policy.reputation) as reputation:
+            for _ in range(5):
+                view(RequestFactory().get('/', REMOTE_ADDR='10.0.0.2'))
+            reputation.assert_not_called()
+            view(RequestFactory().get('/', REMOTE_ADDR='10.0.0.2'))
+            reputation.assert_called_once()
+
+    def test_ip_reputation_is_shared_between_processes(self):
+        SuspiciousIP.objects.record('10.0.0.1', 'high_volume', 'x')
+        self.assertEqual(self.policy.scale(10, '10.0.0.1'), 2)
+
+        other_process = type(self.policy)()
+        with self.assertNumQueries(0):
+            self.assertEqual(other_process.scale(10, '10.0.0.1'), 2)
+
+    def test_adaptive_ratelimit_without_blocking_marks_the_request(self):
+        view = adaptive_ratelimit('other', rate='1/m', block=False)(
+            lambda request: HttpResponse(str(request.limited)))
+        request = lambda: RequestFactory().get('/', REMOTE_ADDR='10.0.0.2')
+        self.assertEqual(view(request()).content, b'False')
+        self.assertEqual(view(request()).content, b'True')
+
+
+@override_settings(CACHES=LOCMEM_CACHES, IP_TRACKING_SKETCHES=NO_SKETCHES)
+class LoadSheddingMiddlewareTests(TestCase):
+
+    def setUp(self):
+        load_blocklist(self)
+        cache.clear()
+        reset_rate_policy()
+        self.addCleanup(reset_rate_policy)
+        SuspiciousIP.objects.record('10.0.0.1', 'high_volume', 'x')
+        patcher = mock.patch.object(LoadMonitor, 'pressure', return_value=2.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.middleware = IPLoggingMiddleware(lambda request: HttpResponse('ok'))
+
+    def test_suspicious_client_gets_503_under_overload(self):
+        response = self.middleware(RequestFactory().get('/', REMOTE_ADDR='10.0.0.1'))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertFalse(RequestLog.objects.exists())
+
+    def test_other_clients_are_served(self):
+        response = self.middleware(RequestFactory().get('/', REMOTE_ADDR='10.0.0.2'))
+        self.assertEqual(response.status_code, 200)
@@ -0,0 +1,13 @@
+from django.urls import include, path
+from rest_framework.routers import DefaultRouter
+
+from .api import BlockedIPViewSet, SuspiciousIPViewSet, TrafficStatsView
+
+router = DefaultRouter()
+router.register('blocked-ips', BlockedIPViewSet, basename='blocked-ip')
+router.register('suspicious-ips', SuspiciousIPViewSet, basename='suspicious-ip')
+
+urlpatterns = [
+    path('', include(router.urls)),
+    path('traffic-stats/', TrafficStatsView.as_view(), name='traffic-stats'),
+]
@@ -1,13 +1,15 @@
 from django.http import JsonResponse
 from .models import RequestLog
 import json
-from .rate_limits import rate_limit_authenticated, rate_limit_by_group
+from .rate_limits import adaptive_ratelimit, rate_limit_authenticated, rate_limit_by_group
 from .models import SuspiciousIP
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth import authenticate, login
+from django.core.paginator import Paginator
 
 from ip_tracking import models
 
+SUSPICIOUS_IPS_PAGE_SIZE = 50
 
 def home(request):
     return JsonResponse({
@@ -62,7 +64,9 @@ def rate_limit_exceeded(request, exception):
     }, status=429)
 
 # Sensitive view with rate limiting for anonymous users
-@ratelimit(key='ip', rate='5/m', method='POST', block=True)
+# Limits are defaults: RATELIMITS['groups'] and RateLimitPolicy rows override
+# them, and the policy scales them by reputation and load
+@adaptive_ratelimit('login', rate='5/m', key='ip', method='POST')
 @csrf_exempt
 def login_view(request):
     """Login view with rate limiting"""
@@ -95,7 +99,7 @@ def login_view(request):
     }, status=405)
 
 # View with different rate limits for authenticated vs anonymous users
-@ratelimit(key='user_or_ip', rate='10/m', method='POST', block=True)
+@adaptive_ratelimit('sensitive_operation', rate='10/m', key='user_or_ip', method='POST')
 @csrf_exempt
 def sensitive_operation(request):
     """A view that performs sensitive operations with rate limiting"""
@@ -121,7 +125,7 @@ def sensitive_operation(request):
     }, status=405)
 
 # API endpoint with IP-based rate limiting
-@ratelimit(key='ip', rate='10/m', method='GET', block=True)
+@adaptive_ratelimit('api_endpoint', rate='10/m', key='ip', method='GET')
 def api_endpoint(request):
     """API endpoint with IP-based rate limiting"""
     return JsonResponse({
@@ -131,8 +135,8 @@ def api_endpoint(request):
     })
 
 # View with method-specific rate limiting
-@ratelimit(key='ip', rate='20/m', method='GET')
-@ratelimit(key='ip', rate='5/m', method='POST', block=True)
+@adaptive_ratelimit('multi_method_get', rate='20/m', key='ip', method='GET', block=False)
+@adaptive_ratelimit('multi_method_post', rate='5/m', key='ip', method='POST')
 @csrf_exempt
 def multi_method_view(request):
     """View with different rate limits for different HTTP methods"""
@@ -189,22 +193,31 @@ def low_limit_sensitive(request):
 
 
 def suspicious_ips_view(request):
-    """View to see currently suspicious IPs"""
-    suspicious_ips = SuspiciousIP.objects.filter(is_resolved=False)
-    
+    """View to see currently suspicious IPs, one page at a time"""
+    open_incidents = (SuspiciousIP.objects.open()
+                      .order_by('-last_seen', '-id')
+                      .values('id', 'ip_address', 'reason', 'description',
+                              'request_count', 'detected_at', 'last_seen'))
+    paginator = Paginator(open_incidents, SUSPICIOUS_IPS_PAGE_SIZE)
+    page = paginator.get_page(request.GET.get('page'))
+
+    reason_labels = dict(SuspiciousIP.REASON_CHOICES)
     ip_data = [
         {
-            'ip_address': ip.ip_address,
-            'reason': ip.reason,
-            'reason_display': ip.get_reason_display(),
-            'description': ip.description,
-            'request_count': ip.request_count,
-            'detected_at': str(ip.detected_at),
+            'ip_address': ip['ip_address'],
+            'reason': ip['reason'],
+            'reason_display': reason_labels.get(ip['reason'], ip['reason']),
+            'description': ip['description'],
+            'request_count': ip['request_count'],
+            'detected_at': str(ip['detected_at']),
+            'last_seen': str(ip['last_seen']),
         }
-        for ip in suspicious_ips
+        for ip in page
     ]
     
     return JsonResponse({
         'suspicious_ips': ip_data,
-        'total_count': suspicious_ips.count()
-    })
\ No newline at end of file
+        'total_count': paginator.count,
+        'page': page.number,
+        'num_pages': paginator.num_pages,
+    })